@@ -1,17 +1,28 @@
 
+import json
 import os
-import yaml # type: ignore
+import resource
+import socket
+import socketserver
+import struct
 
-from typing import Mapping
+from functools import lru_cache
+from typing import Dict, Mapping, Optional, Tuple
 
 from ansible.constants     import DEFAULT_VAULT_ID_MATCH # type: ignore
-from ansible.parsing.vault import VaultLib, VaultSecret  # type: ignore
+from ansible.parsing.vault import VaultAES256, VaultLib, VaultSecret  # type: ignore
 
 from getpass import getpass
 
+from nixostools import serialization_lib
+
 
 UTF8 = "utf-8"
 
+# Environment variable containing the path to the socket of a running vault agent,
+# see nixostools/vault_agent.py.
+VAULT_AGENT_SOCKET_ENV = "NIXOSTOOLS_VAULT_AGENT"
+
 
 # See the following link for the source code and the API of the vault library:
 # https://github.com/ansible/ansible/blob/devel/lib/ansible/parsing/vault/__init__.py
@@ -25,11 +36,61 @@ def print_vault_banner() -> None:
 
 def get_ansible_passwd(args_passwd: str) -> str:
   if not args_passwd:
+    agent_passwd = get_agent_passwd()
+    if agent_passwd is not None:
+      print("Using the vault password from the vault agent.")
+      return agent_passwd
     print_vault_banner()
     return getpass("Vault password: ")
   return args_passwd
 
 
+# Ansible derives the keys for every vault file from the password and the salt
+# of that file, using PBKDF2 with 10000 iterations.
+# Every vault file has its own random salt, so within a single run there is
+# nothing to reuse. When a vault agent is running, we ask it for the keys instead:
+# it keeps the keys it derived in memory, so that the keys of a vault file
+# are only derived once for as long as the agent runs.
+DerivedKeys = Tuple[bytes, bytes, bytes]
+
+# To ask the agent, we hook into VaultAES256._gen_key_initctr, which is a private method
+# of ansible-core. It has the signature _gen_key_initctr(cls, b_password, b_salt) as a classmethod
+# returning (key1, key2, iv) in ansible-core 2.14 (tested) and 2.19 (checked against the source).
+# We only install the hook when a vault agent is configured, and when the method exists,
+# otherwise we use the plain VaultLib, which derives the keys itself.
+_derived_keys: Dict[Tuple[bytes, bytes], DerivedKeys] = {}
+_derive_keys_uncached = getattr(VaultAES256, "_gen_key_initctr", None)
+can_derive_keys = _derive_keys_uncached is not None
+
+
+# Used by the vault agent
+def derive_keys(b_passwd: bytes, b_salt: bytes) -> DerivedKeys:
+  cache_key = (b_passwd, b_salt)
+  if cache_key not in _derived_keys:
+    assert _derive_keys_uncached is not None
+    _derived_keys[cache_key] = _derive_keys_uncached(b_passwd, b_salt)
+  return _derived_keys[cache_key]
+
+
+# Used by the clients of the vault agent
+def derive_keys_with_agent(b_passwd: bytes, b_salt: bytes) -> DerivedKeys:
+  keys = None
+  agent_passwd = get_agent_passwd()
+  # The agent can only derive keys for its own password.
+  if agent_passwd is not None and agent_passwd.encode(UTF8) == b_passwd:
+    keys = get_agent_derived_keys(b_salt)
+  if keys is None:
+    assert _derive_keys_uncached is not None
+    keys = _derive_keys_uncached(b_passwd, b_salt)
+  return keys
+
+
+if can_derive_keys and os.environ.get(VAULT_AGENT_SOCKET_ENV):
+  VaultAES256._gen_key_initctr = classmethod(lambda cls, b_passwd, b_salt:
+                                               derive_keys_with_agent(b_passwd, b_salt))
+
+
+@lru_cache(maxsize = None)
 def get_vaultlib(passwd: str) -> VaultLib:
   return VaultLib([(DEFAULT_VAULT_ID_MATCH, VaultSecret(passwd.encode(UTF8)))])
 
@@ -39,7 +100,7 @@ def read_vault_file(passwd: str,
   vault = get_vaultlib(passwd)
   if os.path.isfile(vault_file):
     with open(vault_file, 'r') as f:
-      return yaml.safe_load(vault.decrypt(f.read(), filename=vault_file)) # type: ignore
+      return serialization_lib.yaml_load(vault.decrypt(f.read(), filename=vault_file)) # type: ignore
   else:
       raise FileNotFoundError(f'Ansible Vault file ({vault_file}): no such file!')
 
@@ -48,7 +109,119 @@ def write_vault_file(passwd: str,
                      vault_file: str,
                      content: Mapping) -> None:
   vault = get_vaultlib(passwd)
-  encrypted_content = vault.encrypt(yaml.safe_dump(content))
+  encrypted_content = vault.encrypt(serialization_lib.yaml_dump(content))
   with open(vault_file, 'wb+') as f:
     f.write(encrypted_content)
 
+
+# The vault agent keeps the vault password and the derived keys in memory only,
+# and serves them over a Unix socket to processes of the same user.
+# The protocol consists of a single JSON request and a single JSON response per connection.
+
+def agent_request(request: Mapping) -> Optional[Mapping]:
+  socket_path = os.environ.get(VAULT_AGENT_SOCKET_ENV)
+  if not socket_path:
+    return None
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.settimeout(60)
+      sock.connect(socket_path)
+      sock.sendall(json.dumps(request).encode(UTF8) + b"\n")
+      with sock.makefile('rb') as f:
+        response = json.loads(f.readline())
+  except (OSError, ValueError) as e:
+    print(f"Could not reach the vault agent at {socket_path} ({e}), continuing without it.")
+    return None
+  return response if isinstance(response, dict) and "error" not in response else None
+
+
+@lru_cache(maxsize = None)
+def get_agent_passwd() -> Optional[str]:
+  response = agent_request({ "op": "passwd" })
+  return str(response["passwd"]) if response is not None else None
+
+
+def get_agent_derived_keys(b_salt: bytes) -> Optional[DerivedKeys]:
+  response = agent_request({ "op": "derive", "salt": b_salt.hex() })
+  if response is None:
+    return None
+  return (bytes.fromhex(response["key1"]),
+          bytes.fromhex(response["key2"]),
+          bytes.fromhex(response["iv"]))
+
+
+def peer_uid(sock: socket.socket) -> int:
+  creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+  (_, uid, _) = struct.unpack('3i', creds)
+  return int(uid)
+
+
+class VaultAgentHandler(socketserver.StreamRequestHandler):
+  server: "VaultAgentServer"
+
+  def handle(self) -> None:
+    if peer_uid(self.request) != os.getuid():
+      return
+    try:
+      request = json.loads(self.rfile.readline())
+      response = self.server.handle_request_data(request)
+    except (ValueError, KeyError, TypeError) as e:
+      response = { "error": f"invalid request: {e}" }
+    self.wfile.write(json.dumps(response).encode(UTF8) + b"\n")
+
+
+class VaultAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path: str, passwd: str) -> None:
+    self.passwd = passwd
+    self.timed_out = False
+    super().__init__(socket_path, VaultAgentHandler)
+
+  def handle_timeout(self) -> None:
+    self.timed_out = True
+
+  def handle_request_data(self, request: Mapping) -> Mapping:
+    op = request["op"]
+    if op == "passwd":
+      return { "passwd": self.passwd }
+    elif op == "derive" and can_derive_keys:
+      (key1, key2, iv) = derive_keys(self.passwd.encode(UTF8), bytes.fromhex(request["salt"]))
+      return { "key1": key1.hex(), "key2": key2.hex(), "iv": iv.hex() }
+    else:
+      return { "error": f"unknown operation: {op}" }
+
+
+def run_vault_agent(socket_path: str, passwd: str, timeout: Optional[float]) -> None:
+  # Keep the password and the keys out of core dumps
+  resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+  # The agent never asks another agent for keys
+  os.environ.pop(VAULT_AGENT_SOCKET_ENV, None)
+
+  socket_dir = os.path.dirname(socket_path)
+  os.makedirs(socket_dir, mode = 0o700, exist_ok = True)
+  socket_dir_stat = os.stat(socket_dir)
+  if socket_dir_stat.st_uid != os.getuid() or socket_dir_stat.st_mode & 0o077:
+    raise PermissionError(f"The directory of the vault agent socket ({socket_dir}) " +
+                          "should be owned by the current user and should not be accessible by others!")
+  if os.path.lexists(socket_path):
+    os.unlink(socket_path)
+
+  old_umask = os.umask(0o177)
+  try:
+    server = VaultAgentServer(socket_path, passwd)
+  finally:
+    os.umask(old_umask)
+
+  # The agent exits once it has been idle for the given amount of time
+  server.timeout = timeout
+  try:
+    with server:
+      while True:
+        server.handle_request()
+        if server.timed_out:
+          break
+  finally:
+    if os.path.lexists(socket_path):
+      os.unlink(socket_path)
@@ -2,129 +2,1133 @@
 #! nix-shell -i python3 ../shell.nix
 
 import argparse
+import collections
+import dataclasses
 import glob
+import hashlib
+import heapq
 import json
 import os
+import queue
 import re
+import selectors
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
+import time
 
-from subprocess import PIPE
-from typing import Iterable, Mapping
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, \
+                               wait
+from dataclasses        import dataclass
+from subprocess         import PIPE
+from typing             import Any, Callable, Counter, Deque, Dict, FrozenSet, Iterable, List, Mapping, \
+                               Optional, Pattern, Sequence, Set, Tuple, TypeVar
+
+from nixostools import ocb_nixos_lib
+
+
+PARTITION_SLICE    = 'slice'
+PARTITION_DURATION = 'duration'
+
+TREE_MODE_COPY     = 'copy'
+TREE_MODE_SYNC     = 'sync'
+TREE_MODE_HARDLINK = 'hardlink'
+
+TREE_IGNORE_PATTERNS = [ '.git', 'result', 'id_tunnel', 'settings.nix' ]
+
+
+# Like shutil.ignore_patterns, but also ignoring the given paths,
+# to be used with shutil.copytree or on the entries of os.walk.
+def tree_ignore(patterns: Sequence[str],
+                excluded_paths: Iterable[str] = ()) -> Callable[[str, List[str]], Set[str]]:
+  ignore_patterns = shutil.ignore_patterns(*patterns)
+  excluded = { os.path.abspath(path) for path in excluded_paths }
+  def ignore(root: str, names: List[str]) -> Set[str]:
+    return set(ignore_patterns(root, names)) | \
+           { name for name in names if os.path.abspath(os.path.join(root, name)) in excluded }
+  return ignore
+
+
+# A retry policy describes a transient failure, recognised by a regex matching
+# a line of the build output, and how often and how fast we retry a build
+# that failed this way. The delay before every retry is doubled, starting from backoff.
+# With abort_early, we stop the build as soon as the regex matches,
+# instead of waiting for the build to fail.
+@dataclass(frozen=True)
+class RetryPolicy:
+  name: str
+  regex: Pattern
+  max_retries: int
+  backoff: float
+  abort_early: bool = False
+
+
+DEFAULT_RETRY_POLICIES: Tuple[RetryPolicy, ...] = (
+  # The ELM compiler sometimes crashes due to a file being locked.
+  # We do not yet understand why this happens, but restarting the build
+  # seems to fix it...
+  RetryPolicy(name = 'elm_lock',
+              regex = re.compile(r"/build/frontend/elm-stuff/.*/d\.dat: openBinaryFile: " +
+                                 r"resource busy \(file is locked\)"),
+              max_retries = 1,
+              backoff = 0,
+              abort_early = True),
+  # The connection to the Nix daemon got lost
+  RetryPolicy(name = 'nix_daemon',
+              regex = re.compile(r"cannot connect to socket at '.*daemon-socket/socket'|" +
+                                 r"error: unexpected end-of-file|" +
+                                 r"Connection reset by peer"),
+              max_retries = 3,
+              backoff = 5),
+  # Downloading from a substituter timed out
+  RetryPolicy(name = 'substituter_timeout',
+              regex = re.compile(r"unable to download '.*': (Timeout was reached|" +
+                                 r"HTTP error 50[234]|Couldn't resolve host name)"),
+              max_retries = 3,
+              backoff = 10),
+)
+
+
+@dataclass(frozen=True)
+class BuildOptions:
+  jobs: int = 1
+  batch: bool = False
+  history_path: Optional[str] = None
+  history_output_path: Optional[str] = None
+  cache_path: Optional[str] = None
+  hash_cache_path: Optional[str] = None
+  force: bool = False
+  tree_mode: str = TREE_MODE_COPY
+  validation_cache_path: Optional[str] = None
+  report_path: Optional[str] = None
+  log_dir: Optional[str] = None
+  retry_policies: Tuple[RetryPolicy, ...] = DEFAULT_RETRY_POLICIES
+  eval_only: bool = False
+
+  # The files and directories written by the build itself, which might be inside the config dir
+  # (e.g. a relative --report or --log_dir), they are neither hashed nor copied to the build tree.
+  def output_paths(self) -> List[str]:
+    return [ path
+             for path in [ self.history_output_path, self.cache_path, self.hash_cache_path,
+                           self.validation_cache_path, self.report_path, self.log_dir ]
+             if path ]
+
+
+@dataclass(frozen=True)
+class BuildResult:
+  config: str
+  returncode: int
+  duration: float
+  drv_path: Optional[str] = None
+  out_path: Optional[str] = None
+  # None when we do not know the evaluation time of this config on its own,
+  # in batch mode all configs are evaluated at once
+  eval_duration: Optional[float] = None
+  realise_duration: float = 0
+  retries: int = 0
+  # The names of the retry policies whose regex matched the build output
+  matched: FrozenSet[str] = frozenset()
+
+
+T = TypeVar('T')
+
+def timed(f: Callable[[], T]) -> Tuple[T, float]:
+  start = time.monotonic()
+  result = f()
+  return (result, time.monotonic() - start)
 
 
 def args_parser() -> argparse.ArgumentParser:
   parser = argparse.ArgumentParser(description='Build all NixOS configs.')
-  parser.add_argument('--group_amount', type = int, dest = 'group_amount', required = True)
-  parser.add_argument('--group_id',     type = int, dest = 'group_id',     required = True)
+  parser.add_argument('--group_amount', type = int, dest = 'group_amount', required = False)
+  parser.add_argument('--group_id',     type = int, dest = 'group_id',     required = False)
   parser.add_argument('--nixos_config_dir', type = str, dest = 'nixos_config_dir',
                       required = False, default = os.getcwd())
+  parser.add_argument('--jobs', type = int, dest = 'jobs', required = False, default = 1,
+                      help = 'the number of configs to build in parallel')
+  parser.add_argument('--partition', type = str, dest = 'partition', required = False,
+                      choices = [ PARTITION_SLICE, PARTITION_DURATION ], default = PARTITION_SLICE,
+                      help = 'how to divide the configs over the build groups, ' +
+                             f'"{PARTITION_DURATION}" balances the groups using the build history')
+  parser.add_argument('--build_history', type = str, dest = 'build_history', required = False,
+                      help = 'the JSON file containing the build duration of every config, ' +
+                             f'required for the "{PARTITION_DURATION}" partition, ' +
+                             'all builders need to use the same file, it is never modified')
+  parser.add_argument('--build_history_output', type = str, dest = 'build_history_output', required = False,
+                      help = 'the JSON file in which we write the build duration of every config ' +
+                             'built successfully, it should not be the build history file itself')
+  parser.add_argument('--batch', dest = 'batch', required = False, action = 'store_true',
+                      help = 'evaluate and build all configs of the group with a single Nix invocation')
+  parser.add_argument('--build_cache', type = str, dest = 'build_cache', required = False,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'build_cache.json'),
+                      help = 'the JSON file in which we keep the inputs hash of every successful build')
+  parser.add_argument('--hash_cache', type = str, dest = 'hash_cache', required = False,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'file_hash_cache.json'),
+                      help = 'the JSON file in which we keep the hashes of the files of the config dir, ' +
+                             'so that we only hash the files whose size or modification time changed')
+  parser.add_argument('--force', dest = 'force', required = False, action = 'store_true',
+                      help = 'build all configs, even when their inputs did not change')
+  parser.add_argument('--tree_mode', type = str, dest = 'tree_mode', required = False,
+                      choices = [ TREE_MODE_COPY, TREE_MODE_SYNC, TREE_MODE_HARDLINK ],
+                      default = TREE_MODE_COPY,
+                      help = 'how to set up the build tree: a fresh copy on every run, ' +
+                             'or an incremental sync of the changed files, ' +
+                             'copying them or using hardlinks')
+  parser.add_argument('--validation_cache', type = str, dest = 'validation_cache', required = False,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'json_validation_cache.json'),
+                      help = 'the JSON file in which we keep the JSON files that were found valid')
+  parser.add_argument('--validate_only', dest = 'validate_only', required = False, action = 'store_true',
+                      help = 'only validate the JSON files in the config dir, without building anything')
+  parser.add_argument('--report', type = str, dest = 'report', required = False,
+                      help = 'the JSON Lines file in which we write the timings of this build')
+  parser.add_argument('--log_dir', type = str, dest = 'log_dir', required = False,
+                      help = 'the directory in which we write the build log of every config')
+  parser.add_argument('--retry_policies', type = str, dest = 'retry_policies', required = False,
+                      help = 'a JSON file containing a list of retry policies, replacing the default ones, ' +
+                             'every policy has a name, regex, max_retries, backoff and abort_early field')
+  parser.add_argument('--eval_only', dest = 'eval_only', required = False, action = 'store_true',
+                      help = 'only evaluate the configs, without building them, and print the evaluation time ' +
+                             'of every config, in batch mode only the time of the shared evaluation is known')
   return parser
 
 
-def validate_json(build_dir: str) -> None:
-  def has_duplicates(kv_pairs: Iterable):
+def read_retry_policies(policies_path: Optional[str]) -> Tuple[RetryPolicy, ...]:
+  if not policies_path:
+    return DEFAULT_RETRY_POLICIES
+  with open(policies_path, 'r') as fp:
+    return tuple(RetryPolicy(name = policy['name'],
+                             regex = re.compile(policy['regex']),
+                             max_retries = int(policy['max_retries']),
+                             backoff = float(policy['backoff']),
+                             abort_early = bool(policy.get('abort_early', False)))
+                 for policy in json.load(fp))
+
+
+# Decide whether a build that failed should be retried,
+# attempts counts the retries that we already did for every policy.
+def next_retry_policy(policies: Sequence[RetryPolicy],
+                      returncode: int,
+                      matched: FrozenSet[str],
+                      attempts: Dict[str, int]) -> Optional[RetryPolicy]:
+  if returncode == 0:
+    return None
+  for policy in policies:
+    if policy.name in matched and attempts.get(policy.name, 0) < policy.max_retries:
+      attempts[policy.name] = attempts.get(policy.name, 0) + 1
+      return policy
+  return None
+
+
+def retry_delay(policy: RetryPolicy, attempts: Mapping[str, int]) -> float:
+  return float(policy.backoff * 2 ** (attempts[policy.name] - 1))
+
+
+# Check a single JSON file, and return all errors that we found in it.
+# When the file's hash matches the given one, the file was already found valid before,
+# and we do not need to parse it again.
+# This function runs in a separate process, so it needs to be defined at the top level.
+def check_json_file(filename: str, valid_hash: Optional[str]) -> Tuple[str, List[str]]:
+  errors: List[str] = []
+
+  def check_duplicates(kv_pairs: List[Tuple[str, object]]) -> None:
     seen = set()
-    for kv in kv_pairs:
-      key = kv[0]
+    for (key, _) in kv_pairs:
       if key in seen:
-        return key
-      else:
-        seen |= { key }
-    return None
+        errors.append(f"Duplicate JSON key ({key}) in {filename}.")
+      seen.add(key)
+
+  with open(filename, 'rb') as fp:
+    content = fp.read()
+  content_hash = hashlib.sha256(content).hexdigest()
+  if content_hash != valid_hash:
+    try:
+      json.loads(content, object_pairs_hook = check_duplicates)
+    except ValueError as e:
+      errors.append(f"Invalid JSON in {filename}: {e}")
+  return (content_hash, errors)
+
+
+# Validate all JSON files in the given directory, in parallel.
+# We keep a cache of the files that were found valid, using their size,
+# modification time and content hash, so that unchanged files can be skipped.
+# All errors are reported at once.
+def validate_json(build_dir: str, cache_path: Optional[str] = None) -> None:
+  ignore = shutil.ignore_patterns(*TREE_IGNORE_PATTERNS)
+  filenames = []
+  for root, dirs, files in os.walk(build_dir):
+    ignored = ignore(root, dirs + files)
+    dirs[:] = [ d for d in dirs if d not in ignored ]
+    filenames += [ os.path.abspath(os.path.join(root, f))
+                   for f in files
+                   if f.endswith('json') and f not in ignored ]
+
+  cache = ocb_nixos_lib.read_json_state(cache_path) if cache_path else {}
+  stats = { filename: os.stat(filename) for filename in filenames }
+  def is_unchanged(filename: str) -> bool:
+    cached = cache.get(filename, {})
+    return (cached.get('size'), cached.get('mtime_ns')) == \
+           (stats[filename].st_size, stats[filename].st_mtime_ns)
+
+  to_check = [ filename for filename in filenames if not is_unchanged(filename) ]
+  print(f"Validating {len(to_check)} JSON files, " + \
+        f"{len(filenames) - len(to_check)} files are unchanged.")
+
+  results: Dict[str, Tuple[str, List[str]]] = {}
+  if to_check:
+    with ProcessPoolExecutor() as executor:
+      results = dict(zip(to_check,
+                         executor.map(check_json_file,
+                                      to_check,
+                                      [ cache.get(f, {}).get('sha256') for f in to_check ],
+                                      chunksize = 16)))
+
+  errors = [ error for (_, file_errors) in results.values() for error in file_errors ]
+
+  # The cache is shared between runs on different directories, e.g. the config dir
+  # and the build tree, so we keep the entries of other directories,
+  # and only drop the entries of files which do not exist anymore.
+  if cache_path:
+    ocb_nixos_lib.write_json_state(cache_path, {
+      **{ filename: entry
+          for (filename, entry) in cache.items()
+          if filename not in results and (filename in stats or os.path.exists(filename)) },
+      **{ filename: { 'size':     stats[filename].st_size,
+                      'mtime_ns': stats[filename].st_mtime_ns,
+                      'sha256':   content_hash }
+          for (filename, (content_hash, file_errors)) in results.items()
+          if not file_errors } })
+
+  for error in errors:
+    print(f"ERROR: {error}")
+  if errors:
+    raise ValueError(f"Found {len(errors)} errors in the JSON files:\n" + '\n'.join(errors))
+
+
+# Files which we create ourselves in the build tree.
+# When using hardlinks, these files might be linked to the files in the source tree,
+# so we always unlink them first instead of overwriting them.
+def write_tree_file(path: str, content: str) -> None:
+  if os.path.lexists(path):
+    os.unlink(path)
+  with open(path, 'w') as fp:
+    fp.write(content)
+
+
+# Update dst_dir so that it contains the same files as src_dir,
+# only the files which changed according to their size and modification time
+# are copied (or hardlinked), and files no longer present in src_dir are removed.
+# Files matched by the ignore patterns are neither synced nor removed,
+# they are managed by the build itself (e.g. settings.nix).
+def sync_tree(src_dir: str,
+              dst_dir: str,
+              ignore_patterns: List[str],
+              hardlink: bool,
+              excluded_paths: Iterable[str] = ()) -> None:
+  ignore = tree_ignore(ignore_patterns, excluded_paths)
+
+  def remove(path: str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path)
+    elif os.path.lexists(path):
+      os.unlink(path)
 
-  def no_duplicates_hook(filename: str):
-    def check_duplicates(kv_pairs) -> None:
-      duplicate_key = has_duplicates(kv_pairs)
-      if duplicate_key:
-        raise ValueError(f"Duplicate JSON key ({duplicate_key}) in {filename}.")
-    return check_duplicates
+  def is_up_to_date(src: os.stat_result, dst: os.stat_result) -> bool:
+    return (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino) or \
+           (src.st_size, src.st_mtime_ns) == (dst.st_size, dst.st_mtime_ns)
 
-  for root, _, files in os.walk(build_dir):
+  def sync_file(src_path: str, dst_path: str) -> None:
+    if os.path.islink(src_path):
+      link = os.readlink(src_path)
+      if not (os.path.islink(dst_path) and os.readlink(dst_path) == link):
+        remove(dst_path)
+        os.symlink(link, dst_path)
+    elif os.path.islink(dst_path) or not os.path.isfile(dst_path) or \
+         not is_up_to_date(os.stat(src_path), os.stat(dst_path)):
+      remove(dst_path)
+      try:
+        if not hardlink:
+          raise OSError("not using hardlinks")
+        os.link(src_path, dst_path)
+      # Hardlinks cannot cross file systems, we fall back to copying in that case
+      except OSError:
+        # copy2 preserves the modification time, which we need to detect changes
+        shutil.copy2(src_path, dst_path)
+
+  synced = set()
+  for root, dirs, files in os.walk(src_dir):
+    ignored = ignore(root, dirs + files)
+    dirs[:] = [ d for d in dirs if d not in ignored ]
+    dst_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+    if os.path.islink(dst_root) or not os.path.isdir(dst_root):
+      remove(dst_root)
+      os.makedirs(dst_root)
+    synced.add(os.path.normpath(dst_root))
+    for d in list(dirs):
+      # Symlinks to directories are synced as symlinks, like copytree does
+      if os.path.islink(os.path.join(root, d)):
+        dirs.remove(d)
+        files.append(d)
     for f in files:
-      filename = os.path.join(root, f)
-      if filename.endswith('json'):
-        with open(filename, 'r') as fp:
-          json.load(fp, object_pairs_hook = no_duplicates_hook(filename))
-
-
-def init_tree(nixos_config_dir: str, build_dir: str) -> None:
-  if os.path.isdir(build_dir):
-    shutil.rmtree(build_dir)
-  shutil.copytree(nixos_config_dir, build_dir,
-                  symlinks = True,
-                  ignore = shutil.ignore_patterns('.git', 'result',
-                                                  'id_tunnel', 'settings.nix'))
+      if f not in ignored:
+        dst_path = os.path.join(dst_root, f)
+        sync_file(os.path.join(root, f), dst_path)
+        synced.add(os.path.normpath(dst_path))
+
+  for root, dirs, files in os.walk(dst_dir):
+    ignored = ignore(root, dirs + files)
+    for name in [ *dirs, *files ]:
+      path = os.path.normpath(os.path.join(root, name))
+      if name not in ignored and path not in synced:
+        remove(path)
+    dirs[:] = [ d for d in dirs
+                if os.path.isdir(os.path.join(root, d)) and
+                   not os.path.islink(os.path.join(root, d)) ]
+
+
+def init_tree(nixos_config_dir: str,
+              build_dir: str,
+              tree_mode: str = TREE_MODE_COPY,
+              excluded_paths: Iterable[str] = ()) -> None:
+  if tree_mode == TREE_MODE_COPY:
+    if os.path.isdir(build_dir):
+      shutil.rmtree(build_dir)
+    shutil.copytree(nixos_config_dir, build_dir,
+                    symlinks = True,
+                    ignore = tree_ignore(TREE_IGNORE_PATTERNS, excluded_paths))
+  else:
+    sync_tree(nixos_config_dir, build_dir, TREE_IGNORE_PATTERNS,
+              hardlink = tree_mode == TREE_MODE_HARDLINK,
+              excluded_paths = excluded_paths)
   # Create a minimal hardware-configuration.nix file
-  with open(os.path.join(build_dir, 'hardware-configuration.nix'), 'w') as fp:
-    fp.write('{}')
+  write_tree_file(os.path.join(build_dir, 'hardware-configuration.nix'), '{}')
   # Create an empty key file
-  with open(os.path.join(build_dir, 'local', 'id_tunnel'), 'w') as _:
-    pass
+  write_tree_file(os.path.join(build_dir, 'local', 'id_tunnel'), '')
+
+
+def worker_tree_path(build_dir: str, worker_id: int) -> str:
+  return f'{build_dir}_worker_{worker_id}'
+
+
+# Every worker needs its own tree, since prepare_tree points the settings.nix
+# symlink to the config being built.
+# The first worker uses the main build tree, the other ones get a copy of it.
+def init_worker_trees(build_dir: str,
+                      jobs: int,
+                      tree_mode: str = TREE_MODE_COPY) -> List[str]:
+  def init_worker_tree(worker_id: int) -> str:
+    worker_dir = worker_tree_path(build_dir, worker_id)
+    if tree_mode == TREE_MODE_COPY:
+      if os.path.isdir(worker_dir):
+        shutil.rmtree(worker_dir)
+      shutil.copytree(build_dir, worker_dir,
+                      symlinks = True,
+                      ignore = shutil.ignore_patterns('settings.nix'))
+    else:
+      sync_tree(build_dir, worker_dir, [ 'settings.nix' ],
+                hardlink = tree_mode == TREE_MODE_HARDLINK)
+    return worker_dir
+
+  return [ build_dir ] + [ init_worker_tree(worker_id) for worker_id in range(1, jobs) ]
 
 
 def prepare_tree(build_dir: str, config_name: str) -> None:
   settings_path = os.path.join(build_dir, 'settings.nix')
   host_config_path = os.path.join(build_dir, 'org-config', 'hosts', config_name)
-  if os.path.exists(settings_path):
+  if os.path.lexists(settings_path):
     os.unlink(settings_path)
   os.symlink(host_config_path, settings_path)
 
 
-ELM_ERROR_REGEX = re.compile(
-  r"/build/frontend/elm-stuff/.*/d\.dat: openBinaryFile: resource busy \(file is locked\)",
-  re.MULTILINE)
+@dataclass(frozen=True)
+class StreamedProcess:
+  returncode: int
+  stdout: bytes
+  # The names of the retry policies whose regex matched a line of the output
+  matched: FrozenSet[str]
 
-# The ELM compiler sometimes crashes due to a file being locked.
-# We do not yet understand why this happens, but restarting the build
-# seems to fix it...
-def retry_if_elm_failed(proc, retry_routine):
-  stderr = proc.stderr.decode() if proc.stderr else ""
-  retry_needed = proc.returncode != 0 and \
-                 ELM_ERROR_REGEX.search(stderr)
-  return proc if not retry_needed else retry_routine()
 
+print_lock = threading.Lock()
 
-def build_config(build_dir: str, hostname: str, retry: bool = False):
-  if retry:
-    print(f'Retry building config: {hostname}')
+# When building in parallel, we prefix every line with the name of the config,
+# so that we can tell apart the logs of the different builds.
+def print_line(prefix: str, line: str) -> None:
+  with print_lock:
+    print(f'[{prefix}] {line}')
+
+
+def stop_process_group(proc: subprocess.Popen, sig: int) -> None:
+  try:
+    os.killpg(proc.pid, sig)
+  except ProcessLookupError:
+    pass
+
+
+# The Nix commands run in their own process group (see run_streaming),
+# so they do not get the SIGINT when Ctrl-C is pressed in the terminal.
+# We keep track of the running commands, so that the main thread can stop them
+# when it gets interrupted or terminated, also when they run in worker threads.
+running_processes: Set[subprocess.Popen] = set()
+running_processes_lock = threading.Lock()
+stopping = threading.Event()
+
+
+def register_process(proc: subprocess.Popen) -> None:
+  with running_processes_lock:
+    running_processes.add(proc)
+    # Commands started while we are stopping, are stopped right away
+    if stopping.is_set():
+      stop_process_group(proc, signal.SIGKILL)
+
+
+def unregister_process(proc: subprocess.Popen) -> None:
+  with running_processes_lock:
+    running_processes.discard(proc)
+
+
+def stop_running_processes() -> None:
+  with running_processes_lock:
+    stopping.set()
+    for proc in running_processes:
+      if proc.poll() is None:
+        stop_process_group(proc, signal.SIGKILL)
+
+
+# Python only raises KeyboardInterrupt for SIGINT,
+# we want to stop the running commands on SIGTERM as well.
+def handle_sigterm(signum: int, frame: Any) -> None:
+  raise SystemExit(128 + signum)
+
+
+# Run the given command and stream its output line by line, prefixed with the given prefix,
+# to the console and to the log file <log_dir>/<prefix>.log.
+# Only stdout is kept in memory, since we need it to get the resulting paths.
+# Every line is matched against the regexes of the retry policies while the command is running,
+# if a policy with abort_early matches, we stop the command right away.
+def run_streaming(args: List[str],
+                  prefix: str,
+                  log_dir: Optional[str] = None,
+                  policies: Sequence[RetryPolicy] = (),
+                  abort_early: bool = True) -> StreamedProcess:
+  log_file = open(os.path.join(log_dir, f'{prefix}.log'), 'ab') if log_dir else None
+  # We run the command in its own process group, so that we can stop it
+  # together with its child processes, which might still hold our pipes open.
+  proc = subprocess.Popen(args, stdout = PIPE, stderr = PIPE, start_new_session = True)
+  register_process(proc)
+  assert proc.stdout and proc.stderr
+  stdout_fd = proc.stdout.fileno()
+  partial_lines = { stdout_fd: b'', proc.stderr.fileno(): b'' }
+  stdout_chunks: List[bytes] = []
+  matched = set()
+
+  try:
+    with selectors.DefaultSelector() as selector:
+      for fd in partial_lines:
+        selector.register(fd, selectors.EVENT_READ)
+      while selector.get_map():
+        for (key, _) in selector.select():
+          fd = key.fd
+          data = os.read(fd, 64 * 1024)
+          if fd == stdout_fd:
+            stdout_chunks.append(data)
+          if data:
+            *lines, partial_lines[fd] = (partial_lines[fd] + data).split(b'\n')
+          else:
+            selector.unregister(fd)
+            lines = [ partial_lines[fd] ] if partial_lines[fd] else []
+          for line in lines:
+            decoded = line.decode(errors = 'replace')
+            print_line(prefix, decoded)
+            if log_file:
+              log_file.write(line + b'\n')
+            for policy in policies:
+              if policy.regex.search(decoded):
+                matched.add(policy.name)
+                if abort_early and policy.abort_early and proc.poll() is None:
+                  print_line(prefix, 'Stopping the build, since it will need to be retried.')
+                  stop_process_group(proc, signal.SIGTERM)
+    returncode = proc.wait()
+  finally:
+    # When this thread gets interrupted (only the main thread can be, e.g. in batch mode),
+    # or fails, we stop the command ourselves, since it does not share our process group.
+    # Commands running in worker threads are stopped by stop_running_processes.
+    unregister_process(proc)
+    if proc.poll() is None:
+      stop_process_group(proc, signal.SIGKILL)
+      proc.wait()
+    if log_file:
+      log_file.close()
+
+  return StreamedProcess(returncode = returncode,
+                         stdout = b''.join(stdout_chunks),
+                         matched = frozenset(matched))
+
+
+# In batch mode, we generate a Nix expression containing the system of every config
+# to build, so that we only need a single evaluation for all of them.
+# Since configuration.nix imports settings.nix, we generate a settings.nix
+# that imports the host config given to it through the module system's specialArgs.
+BATCH_SETTINGS_NIX = """
+{ batch_host_config, ... }:
+
+{
+  imports = [ batch_host_config ];
+}
+"""
+
+BATCH_FILE_NAME = 'batch.nix'
+
+def batch_attr_name(index: int) -> str:
+  return f'config_{index}'
+
+
+def prepare_batch_tree(build_dir: str, configs: List[str]) -> str:
+  settings_path = os.path.join(build_dir, 'settings.nix')
+  if os.path.lexists(settings_path):
+    os.unlink(settings_path)
+  with open(settings_path, 'w') as fp:
+    fp.write(BATCH_SETTINGS_NIX)
+
+  def batch_attr(index: int, config: str) -> str:
+    host_config_path = os.path.join(build_dir, 'org-config', 'hosts',
+                                    os.path.basename(config))
+    return f'  {batch_attr_name(index)} = eval_config {host_config_path};'
+
+  batch_path = os.path.join(build_dir, BATCH_FILE_NAME)
+  with open(batch_path, 'w') as fp:
+    fp.write('\n'.join([
+      'let',
+      '  eval_config = host_config:',
+      '    (import <nixpkgs/nixos/lib/eval-config.nix> {',
+      f'      modules = [ {os.path.join(build_dir, "configuration.nix")} ];',
+      '      specialArgs = { batch_host_config = host_config; };',
+      '    }).config.system.build.toplevel;',
+      'in {',
+      *[ batch_attr(index, config) for (index, config) in enumerate(configs) ],
+      '}',
+      '' ]))
+  return batch_path
+
+
+def instantiate_batch(batch_path: str,
+                      attrs: List[str],
+                      prefix: str,
+                      log_dir: Optional[str]) -> StreamedProcess:
+  return run_streaming([ 'nix-instantiate', batch_path,
+                         *[ arg for attr in attrs for arg in [ '-A', attr ] ] ],
+                       prefix, log_dir)
+
+
+# We never stop the batch build early when a transient failure occurs,
+# since the other configs are still being built.
+def realise_batch(drvs: List[str],
+                  log_dir: Optional[str],
+                  policies: Sequence[RetryPolicy]) -> StreamedProcess:
+  print(f'Building {len(drvs)} configs...')
+  return run_streaming([ 'nix-store', '--realise', '--keep-going', *drvs ],
+                       'batch', log_dir, policies, abort_early = False)
+
+
+# Return the outputs of the given derivation, or an empty list
+# if not all of them have been built.
+def built_outputs(drv: str) -> List[str]:
+  proc = subprocess.run([ 'nix-store', '--query', '--outputs', drv ],
+                        stdout = PIPE, stderr = PIPE)
+  outputs = proc.stdout.decode().split()
+  built = proc.returncode == 0 and all(os.path.exists(output) for output in outputs)
+  return outputs if built else []
+
+
+# Evaluate all configs with a single nix-instantiate call and build the resulting
+# derivations with a single nix-store call, every config still gets its own result.
+# When the evaluation fails, we cannot tell which config caused the failure,
+# in that case we evaluate the configs one by one to find out.
+def build_configs_in_batch(build_dir: str,
+                           configs: List[str],
+                           jobs: int,
+                           phases: Dict[str, float],
+                           log_dir: Optional[str] = None,
+                           policies: Sequence[RetryPolicy] = DEFAULT_RETRY_POLICIES,
+                           eval_only: bool = False) -> List[BuildResult]:
+  batch_path = prepare_batch_tree(build_dir, configs)
+  attrs = [ batch_attr_name(index) for index in range(len(configs)) ]
+
+  print(f'Evaluating {len(configs)} configs...')
+  (proc, phases['evaluation']) = timed(lambda: instantiate_batch(batch_path, attrs,
+                                                                 'batch', log_dir))
+  eval_durations: List[Optional[float]] = [ None ] * len(configs)
+  if proc.returncode == 0:
+    drvs: List[Optional[str]] = list(proc.stdout.decode().split())
   else:
-    print(f'Building config: {hostname}')
+    print('Batch evaluation failed, evaluating the configs one by one...')
+    def instantiate_config(index: int) -> Optional[str]:
+      (config_proc, eval_durations[index]) = timed(lambda: instantiate_batch(
+                                                              batch_path, [ attrs[index] ],
+                                                              os.path.basename(configs[index]),
+                                                              log_dir))
+      if config_proc.returncode != 0:
+        return None
+      return config_proc.stdout.decode().strip()
+    def instantiate_configs() -> List[Optional[str]]:
+      with ThreadPoolExecutor(max_workers = jobs) as executor:
+        return list(executor.map(instantiate_config, range(len(configs))))
+    (drvs, phases['evaluation_per_config']) = timed(instantiate_configs)
+
+  if eval_only:
+    return [ BuildResult(config = config,
+                         returncode = 0 if drv else 1,
+                         duration = 0,
+                         drv_path = drv,
+                         eval_duration = eval_duration)
+             for (config, drv, eval_duration) in zip(configs, drvs, eval_durations) ]
+
+  evaluated = [ drv for drv in drvs if drv ]
+  retries: Counter[str] = collections.Counter()
+  if evaluated:
+    (proc, phases['realisation']) = timed(lambda: realise_batch(evaluated, log_dir, policies))
+    # When a transient failure occurred, we retry the configs that failed
+    attempts: Dict[str, int] = {}
+    policy = next_retry_policy(policies, proc.returncode, proc.matched, attempts)
+    while policy:
+      failed_drvs = [ drv for drv in evaluated if not built_outputs(drv) ]
+      delay = retry_delay(policy, attempts)
+      print(f'Retry building {len(failed_drvs)} configs in {delay:.0f}s ({policy.name})')
+      time.sleep(delay)
+      retries.update(failed_drvs)
+      (proc, retry_duration) = timed(lambda: realise_batch(failed_drvs, log_dir, policies))
+      phases['realisation_retries'] = phases.get('realisation_retries', 0) + retry_duration
+      policy = next_retry_policy(policies, proc.returncode, proc.matched, attempts)
+
+  return [ BuildResult(config = config,
+                       returncode = 0 if outputs else 1,
+                       duration = 0,
+                       drv_path = drv,
+                       out_path = outputs[0] if outputs else None,
+                       retries = retries[drv] if drv else 0)
+           for (config, drv) in zip(configs, drvs)
+           for outputs in [ built_outputs(drv) if drv else [] ] ]
+
+
+# We first evaluate the config and then realise the resulting derivation,
+# so that we can tell how much time is spent in both of these steps.
+# When we retry a config for which the evaluation succeeded,
+# the derivation is passed in and we only need to realise it again.
+# With eval_only, we stop after the evaluation.
+def build_config(build_dir: str,
+                 hostname: str,
+                 log_dir: Optional[str] = None,
+                 policies: Sequence[RetryPolicy] = DEFAULT_RETRY_POLICIES,
+                 drv_path: Optional[str] = None,
+                 eval_only: bool = False) -> BuildResult:
   config_name = os.path.basename(hostname)
-  prepare_tree(build_dir, config_name)
-  config_path = os.path.join(build_dir, 'configuration.nix')
-  proc = subprocess.run([ 'nix-build',
-                          '<nixpkgs/nixos>',
-                          '-I', f'nixos-config={config_path}',
-                          '-A', 'system',
-                          '--no-out-link' ],
+  eval_duration = 0.0
+  if not drv_path:
+    print(f'Building config: {hostname}')
+    prepare_tree(build_dir, config_name)
+    config_path = os.path.join(build_dir, 'configuration.nix')
+    (proc, eval_duration) = timed(lambda: run_streaming([ 'nix-instantiate',
+                                                          '<nixpkgs/nixos>',
+                                                          '-I', f'nixos-config={config_path}',
+                                                          '-A', 'system' ],
+                                                        config_name, log_dir, policies))
+    if proc.returncode != 0:
+      return BuildResult(config = hostname,
+                         returncode = proc.returncode,
+                         duration = eval_duration,
+                         eval_duration = eval_duration,
+                         matched = proc.matched)
+    drv_path = proc.stdout.decode().strip()
+    if eval_only:
+      return BuildResult(config = hostname,
+                         returncode = 0,
+                         duration = eval_duration,
+                         drv_path = drv_path,
+                         eval_duration = eval_duration,
+                         matched = proc.matched)
+  else:
+    print(f'Retry building config: {hostname}')
+
+  (proc, realise_duration) = timed(lambda: run_streaming([ 'nix-store', '--realise', drv_path ],
+                                                         config_name, log_dir, policies))
+  out_path = proc.stdout.decode().strip() if proc.returncode == 0 else None
+  return BuildResult(config = hostname,
+                     returncode = proc.returncode,
+                     duration = eval_duration + realise_duration,
+                     drv_path = drv_path,
+                     out_path = out_path or None,
+                     eval_duration = eval_duration,
+                     realise_duration = realise_duration,
+                     matched = proc.matched)
+
+
+# Combine the results of all attempts to build a config
+def combine_attempts(attempts: List[BuildResult]) -> BuildResult:
+  return dataclasses.replace(attempts[-1],
+                             duration = sum(a.duration for a in attempts),
+                             eval_duration = sum(a.eval_duration or 0 for a in attempts),
+                             realise_duration = sum(a.realise_duration for a in attempts),
+                             retries = len(attempts) - 1)
+
+
+# The build history maps the name of every config to the duration,
+# in seconds, of its last successful build.
+# All builders partition the configs using the same, read-only, history file,
+# the durations of a build are written to a separate output file,
+# otherwise builders reading the history at different times would disagree
+# on the partition, and configs would be skipped or built twice.
+def read_build_history(history_path: Optional[str]) -> Mapping[str, float]:
+  return ocb_nixos_lib.read_json_state(history_path) if history_path else {}
+
+
+# Digest of the build history, which builders print so that we can verify
+# that they all partitioned the configs using the same history.
+def build_history_digest(history: Mapping[str, float]) -> str:
+  return hashlib.sha256(json.dumps(history, sort_keys = True).encode()).hexdigest()
+
+
+def write_build_history(history_output_path: Optional[str],
+                        results: Iterable[BuildResult]) -> None:
+  if history_output_path:
+    ocb_nixos_lib.write_json_state(history_output_path, {
+      **read_build_history(history_output_path),
+      **{ os.path.basename(result.config): round(result.duration, 3)
+          for result in results
+          if result.returncode == 0 } })
+
+
+def hash_file(path: str) -> str:
+  sha = hashlib.sha256()
+  if os.path.islink(path):
+    sha.update(os.readlink(path).encode())
+  else:
+    with open(path, 'rb') as fp:
+      for block in iter(lambda: fp.read(1024 * 1024), b''):
+        sha.update(block)
+  return sha.hexdigest()
+
+
+# The revision of nixpkgs is identified by the location it resolves to,
+# which is a content-addressed store path when using channels.
+# For a nixpkgs checkout we include the revision files that nixpkgs provides.
+def nixpkgs_revision() -> str:
+  proc = subprocess.run([ 'nix-instantiate', '--find-file', 'nixpkgs' ],
                         stdout = PIPE, stderr = PIPE)
-  print(proc.stderr.decode())
-  print(proc.stdout.decode())
+  nixpkgs_path = os.path.realpath(proc.stdout.decode().strip())
+  revision_files = [ os.path.join(nixpkgs_path, f)
+                     for f in [ '.git-revision', '.version-suffix' ] ]
+  return ' '.join([ nixpkgs_path,
+                    *[ hash_file(f) for f in revision_files if os.path.isfile(f) ] ])
+
+
+# Hash all inputs shared by the configs, that is the nixpkgs revision
+# and every file of the config repo that ends up in the build tree,
+# except for the host configs themselves.
+# The host configs are hashed separately, see config_inputs_hash.
+# Like validate_json, we keep the hashes of the files in a cache,
+# and only hash the files whose size or modification time changed.
+def shared_inputs_hash(nixos_config_dir: str,
+                       cache_path: Optional[str] = None,
+                       excluded_paths: Iterable[str] = ()) -> str:
+  hosts_dir = os.path.join(nixos_config_dir, 'org-config', 'hosts')
+  ignore = tree_ignore(TREE_IGNORE_PATTERNS, excluded_paths)
+  paths: List[str] = []
+  for root, dirs, files in os.walk(nixos_config_dir):
+    ignored = ignore(root, dirs + files)
+    dirs[:] = sorted(d for d in dirs if d not in ignored)
+    if os.path.normpath(root) == os.path.normpath(hosts_dir):
+      continue
+    paths += [ os.path.abspath(os.path.join(root, f)) for f in sorted(files) if f not in ignored ]
+
+  cache = ocb_nixos_lib.read_json_state(cache_path) if cache_path else {}
+  stats = { path: os.lstat(path) for path in paths }
+  def file_hash(path: str) -> str:
+    cached = cache.get(path, {})
+    if cached.get('sha256') and \
+       (cached.get('size'), cached.get('mtime_ns')) == (stats[path].st_size, stats[path].st_mtime_ns):
+      return str(cached['sha256'])
+    return hash_file(path)
+  hashes = { path: file_hash(path) for path in paths }
+
+  # The cache is shared between runs on different directories,
+  # so we only drop the entries of files which do not exist anymore.
+  if cache_path:
+    ocb_nixos_lib.write_json_state(cache_path, {
+      **{ path: entry
+          for (path, entry) in cache.items()
+          if path not in hashes and os.path.lexists(path) },
+      **{ path: { 'size':     stats[path].st_size,
+                  'mtime_ns': stats[path].st_mtime_ns,
+                  'sha256':   hashes[path] }
+          for path in paths } })
+
+  sha = hashlib.sha256(nixpkgs_revision().encode())
+  for path in paths:
+    sha.update(f'{os.path.relpath(path, nixos_config_dir)}\0{hashes[path]}\0'.encode())
+  return sha.hexdigest()
+
+
+def config_inputs_hash(shared_hash: str, config: str) -> str:
+  return hashlib.sha256(
+    f'{shared_hash}\0{os.path.basename(config)}\0{hash_file(config)}'.encode()
+  ).hexdigest()
+
+
+# The build cache maps the name of every config to the hash of the inputs
+# of its last successful build, together with the resulting derivation and output.
+# Configs whose inputs did not change since then, do not need to be built again.
+def read_build_cache(cache_path: Optional[str]) -> Mapping[str, Mapping]:
+  return ocb_nixos_lib.read_json_state(cache_path) if cache_path else {}
+
+
+def write_build_cache(cache_path: Optional[str],
+                      results: Iterable[BuildResult],
+                      input_hashes: Mapping[str, str]) -> None:
+  if cache_path:
+    ocb_nixos_lib.write_json_state(cache_path, {
+      **read_build_cache(cache_path),
+      **{ os.path.basename(result.config): { 'inputs_hash': input_hashes[result.config],
+                                             'drv_path':    result.drv_path,
+                                             'out_path':    result.out_path }
+          for result in results
+          if result.returncode == 0 } })
 
-  retry_routine = lambda: build_config(build_dir, hostname, True)
-  # If we are already retrying, we do not consider retrying again,
-  # otherwise we run the routine to decide if we need to retry.
-  return proc if retry else retry_if_elm_failed(proc, retry_routine)
 
+# Write a JSON Lines report with the duration of every phase of the build,
+# followed by the result and timings of every config and a summary of the build.
+def write_build_report(report_path: Optional[str],
+                       phases: Mapping[str, float],
+                       results: List[BuildResult],
+                       cached: List[str],
+                       wall_time: float,
+                       options: BuildOptions) -> None:
+  if not report_path:
+    return
+  config_events = [ { 'event':            'config',
+                      'config':           os.path.basename(result.config),
+                      'status':           'success' if result.returncode == 0 else 'failure',
+                      'duration':         round(result.duration, 3),
+                      'eval_duration':    round(result.eval_duration, 3) \
+                                          if result.eval_duration is not None else None,
+                      'realise_duration': round(result.realise_duration, 3),
+                      'retries':          result.retries,
+                      'drv_path':         result.drv_path,
+                      'out_path':         result.out_path }
+                    for result in results ] + \
+                  [ { 'event':  'config',
+                      'config': os.path.basename(config),
+                      'status': 'cached' }
+                    for config in cached ]
+  summary_event = { 'event':     'summary',
+                    'timestamp': time.time(),
+                    'mode':      'batch' if options.batch else 'workers',
+                    'eval_only': options.eval_only,
+                    'jobs':      options.jobs,
+                    'tree_mode': options.tree_mode,
+                    'wall_time': round(wall_time, 3),
+                    'built':     len(results),
+                    'failed':    len([ r for r in results if r.returncode != 0 ]),
+                    'cached':    len(cached),
+                    'retries':   sum(result.retries for result in results) }
+  os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok = True)
+  with open(report_path, 'w') as fp:
+    for event in [ *[ { 'event': 'phase', 'phase': phase, 'duration': round(duration, 3) }
+                      for (phase, duration) in phases.items() ],
+                   *config_events,
+                   summary_event ]:
+      fp.write(json.dumps(event) + '\n')
+  print(f"Wrote the build report to {report_path}")
 
+
+def format_duration(duration: Optional[float]) -> str:
+  return f"{duration:>8.1f}s" if duration is not None else f"{'n/a':>9}"
+
+
+def print_evaluations(results: List[BuildResult]) -> None:
+  print("Evaluated configs:")
+  for result in sorted(results, key = lambda result: result.config):
+    print(f"  {os.path.basename(result.config):<32} {format_duration(result.eval_duration)} " + \
+          f"{result.drv_path or 'evaluation failed'}")
+
+
+def print_build_summary(phases: Mapping[str, float],
+                        results: List[BuildResult],
+                        cached: List[str],
+                        wall_time: float,
+                        slowest_count: int = 10) -> None:
+  print("Build phases:")
+  for (phase, duration) in phases.items():
+    print(f"  {phase:<24} {duration:>9.1f}s")
+  slowest = sorted(results, key = lambda result: result.duration, reverse = True)[:slowest_count]
+  if any(result.duration for result in slowest):
+    print(f"Slowest configs:")
+    print(f"  {'config':<32} {'eval':>9} {'realise':>9} {'total':>9} retries")
+    for result in slowest:
+      print(f"  {os.path.basename(result.config):<32} " + \
+            f"{format_duration(result.eval_duration)} {result.realise_duration:>8.1f}s " + \
+            f"{result.duration:>8.1f}s {result.retries:>7}")
+  print(f"Total wall time: {wall_time:.1f}s, built {len(results)} configs, " + \
+        f"{len(cached)} cache hits, {sum(result.retries for result in results)} retries.")
+
+
+# Build the given configs, either in batch or using a pool of workers.
+# We build all configs, even when some of them fail,
+# and report all failures at the end.
 def do_build_configs(nixos_config_dir: str,
                      build_dir: str,
-                     configs: Iterable) -> None:
-  init_tree(nixos_config_dir, build_dir)
-  validate_json(build_dir)
-  for config in configs:
-    proc = build_config(build_dir, config)
-    proc.check_returncode()
+                     configs: Iterable,
+                     options: BuildOptions = BuildOptions()) -> None:
+  start = time.monotonic()
+  configs = list(configs)
+  phases: Dict[str, float] = {}
 
+  def cache_lookup() -> List[str]:
+    shared_hash = shared_inputs_hash(nixos_config_dir, options.hash_cache_path,
+                                     options.output_paths())
+    input_hashes.update({ config: config_inputs_hash(shared_hash, config)
+                          for config in configs })
+    cache = {} if options.force else read_build_cache(options.cache_path)
+    return [ config for config in configs
+             if cache.get(os.path.basename(config), {}) \
+                     .get('inputs_hash') == input_hashes[config] ]
 
-def build_configs(nixos_config_dir: str,
-                  build_dir: str,
+  input_hashes: Dict[str, str] = {}
+  (cached, phases['cache_lookup']) = timed(cache_lookup)
+  if cached:
+    print(f"Skipping {len(cached)} configs whose inputs did not change " + \
+          f"since their last successful build: {[ os.path.basename(c) for c in cached ]}")
+  configs = [ config for config in configs if config not in cached ]
+
+  results: List[BuildResult] = []
+  if configs:
+    # There is no point in having more workers than configs to build
+    jobs = max(1, min(options.jobs, len(configs)))
+
+    (_, phases['init_tree']) = timed(lambda: init_tree(nixos_config_dir, build_dir,
+                                                       options.tree_mode,
+                                                       options.output_paths()))
+    (_, phases['validate_json']) = timed(lambda: validate_json(build_dir,
+                                                               options.validation_cache_path))
+
+    if options.log_dir:
+      os.makedirs(options.log_dir, exist_ok = True)
+    if options.batch:
+      results = build_configs_in_batch(build_dir, configs, jobs, phases, options.log_dir,
+                                       options.retry_policies, options.eval_only)
+    else:
+      results = build_configs_in_workers(build_dir, configs, jobs, options.tree_mode, phases,
+                                         options.log_dir, options.retry_policies,
+                                         options.eval_only)
+    # A successful evaluation does not guarantee a successful build,
+    # so we only record the configs that we actually built.
+    if options.eval_only:
+      print_evaluations(results)
+    else:
+      if not options.batch:
+        write_build_history(options.history_output_path, results)
+      write_build_cache(options.cache_path, results, input_hashes)
+  else:
+    print("Nothing to build.")
+
+  wall_time = time.monotonic() - start
+  print_build_summary(phases, results, cached, wall_time)
+  write_build_report(options.report_path, phases, results, cached, wall_time, options)
+
+  failed = sorted(os.path.basename(result.config)
+                  for result in results
+                  if result.returncode != 0)
+  action = 'evaluate' if options.eval_only else 'build'
+  print(f"{'Evaluated' if options.eval_only else 'Built'} {len(results)} configs, " + \
+        f"{len(failed)} failed.")
+  if failed:
+    raise Exception(f"The following configs failed to {action}: {', '.join(failed)}")
+
+
+# Build the given configs using a pool of jobs workers,
+# every worker builds in its own tree.
+# When a build fails with a transient failure, as described by the retry policies,
+# we put the config back at the end of the work queue, together with the time
+# at which it can be retried. This way the workers keep building other configs
+# while waiting for the backoff delay to pass.
+def build_configs_in_workers(build_dir: str,
+                             configs: List[str],
+                             jobs: int,
+                             tree_mode: str,
+                             phases: Dict[str, float],
+                             log_dir: Optional[str] = None,
+                             policies: Sequence[RetryPolicy] = DEFAULT_RETRY_POLICIES,
+                             eval_only: bool = False) -> List[BuildResult]:
+  (worker_trees, phases['init_worker_trees']) = \
+    timed(lambda: init_worker_trees(build_dir, jobs, tree_mode))
+  trees: queue.Queue = queue.Queue()
+  for tree in worker_trees:
+    trees.put(tree)
+
+  def build_in_worker_tree(config: str, drv_path: Optional[str]) -> BuildResult:
+    tree = trees.get()
+    try:
+      return build_config(tree, config, log_dir, policies, drv_path, eval_only)
+    finally:
+      trees.put(tree)
+
+  work: Deque[Tuple[str, float]] = collections.deque((config, 0.0) for config in configs)
+  attempts: Dict[str, List[BuildResult]] = { config: [] for config in configs }
+  retry_attempts: Dict[str, Dict[str, int]] = { config: {} for config in configs }
+
+  def build_all() -> List[BuildResult]:
+    results: List[BuildResult] = []
+    running: Dict[Future, str] = {}
+    executor = ThreadPoolExecutor(max_workers = jobs)
+    try:
+      while work or running:
+        now = time.monotonic()
+        ready = [ item for item in work if item[1] <= now ]
+        for item in ready[:jobs - len(running)]:
+          work.remove(item)
+          (config, _) = item
+          drv_path = attempts[config][-1].drv_path if attempts[config] else None
+          running[executor.submit(build_in_worker_tree, config, drv_path)] = config
+
+        next_ready = min((not_before for (_, not_before) in work if not_before > now),
+                         default = None)
+        timeout = next_ready - now if next_ready is not None else None
+        if not running:
+          time.sleep(timeout or 0)
+          continue
+
+        (done, _) = wait(running, timeout = timeout, return_when = FIRST_COMPLETED)
+        for future in done:
+          config = running.pop(future)
+          result = future.result()
+          attempts[config].append(result)
+          policy = next_retry_policy(policies, result.returncode, result.matched,
+                                     retry_attempts[config])
+          if policy:
+            delay = retry_delay(policy, retry_attempts[config])
+            print(f"Build of {os.path.basename(config)} failed ({policy.name}), " + \
+                  f"retry {retry_attempts[config][policy.name]}/{policy.max_retries} " + \
+                  f"scheduled in {delay:.0f}s.")
+            work.append((config, time.monotonic() + delay))
+          else:
+            results.append(combine_attempts(attempts[config]))
+    except BaseException:
+      # KeyboardInterrupt and SystemExit are only raised in the main thread,
+      # so we stop the commands of the worker threads before waiting for them.
+      stop_running_processes()
+      executor.shutdown(wait = True, cancel_futures = True)
+      raise
+    executor.shutdown(wait = True)
+    return results
+
+  (results, phases['build']) = timed(build_all)
+  return results
+
+
+# Select the configs belonging to the given group by dividing the sorted list
+# of configs in group_amount contiguous slices of (almost) equal size.
+def slice_configs(configs: List[str],
                   group_amount: int,
-                  group_id: int) -> None:
-  configs = sorted(glob.glob(
-    os.path.join(nixos_config_dir, 'org-config', 'hosts', '*.nix')))
+                  group_id: int) -> List[str]:
   length = len(configs)
 
   # Let's imagine 10 configs, and 4 builders, in that case the slice_size is 10 / 4 = 2
@@ -142,12 +1146,74 @@ def build_configs(nixos_config_dir: str,
 
   print(f"Found {length} configs, {group_amount} builders, " + \
         f"building group ID {group_id}, starting at {begin}, building {size} configs.")
-  print(f"Configs to build: {configs[begin:end]}")
+  return configs[begin:end]
+
+
+# Select the configs belonging to the given group by dividing the configs
+# over group_amount groups with a similar total build duration.
+# We use the longest-processing-time-first heuristic: we go over the configs,
+# from the slowest to the fastest one, and every time we assign the config
+# to the group that currently has the lowest total duration.
+# Configs without a build history are assumed to take the average duration.
+# Every builder runs this independently, so the outcome needs to be
+# deterministic, ties are broken using the config name and the group ID.
+def partition_configs_by_duration(configs: List[str],
+                                  history: Mapping[str, float],
+                                  group_amount: int,
+                                  group_id: int) -> List[str]:
+  known = [ history[os.path.basename(config)]
+            for config in configs
+            if os.path.basename(config) in history ]
+  default_duration = sum(known) / len(known)
+  durations = { config: history.get(os.path.basename(config), default_duration)
+                for config in configs }
+
+  groups: List[List[str]] = [ [] for _ in range(group_amount) ]
+  loads = [ (0.0, group) for group in range(group_amount) ]
+  for config in sorted(configs, key = lambda config: (-durations[config], config)):
+    (load, group) = heapq.heappop(loads)
+    groups[group].append(config)
+    heapq.heappush(loads, (load + durations[config], group))
+
+  group_load = sum(durations[config] for config in groups[group_id])
+  print(f"Found {len(configs)} configs ({len(known)} with build history), " + \
+        f"{group_amount} builders, building group ID {group_id}, " + \
+        f"building {len(groups[group_id])} configs, estimated at {group_load:.0f}s.")
+  return sorted(groups[group_id])
+
+
+def build_configs(nixos_config_dir: str,
+                  build_dir: str,
+                  group_amount: int,
+                  group_id: int,
+                  partition: str = PARTITION_SLICE,
+                  options: BuildOptions = BuildOptions()) -> None:
+  configs = sorted(glob.glob(
+    os.path.join(nixos_config_dir, 'org-config', 'hosts', '*.nix')))
+
+  history = read_build_history(options.history_path) if partition == PARTITION_DURATION else {}
+  has_history = any(os.path.basename(config) in history for config in configs)
+  if partition == PARTITION_DURATION:
+    print(f"Using build history {options.history_path} with digest {build_history_digest(history)}.")
+    if not has_history:
+      print(f"No build history found in {options.history_path}, " + \
+            "falling back to slicing the configs.")
+
+  if partition == PARTITION_DURATION and has_history:
+    group_configs = partition_configs_by_duration(configs, history, group_amount, group_id)
+  else:
+    group_configs = slice_configs(configs, group_amount, group_id)
+  print(f"Configs to build: {group_configs}")
 
-  do_build_configs(nixos_config_dir, build_dir, configs[begin:end])
+  do_build_configs(nixos_config_dir, build_dir, group_configs, options)
 
 
 def validate_args(args):
+  if args.validate_only:
+    return args
+  if args.group_amount is None or args.group_id is None:
+    raise ValueError("The group amount and the build group ID are required, " + \
+                     "unless only validating the JSON files.")
   if args.group_amount < 1:
     raise ValueError(f"The group amount ({args.group_amount}) should be at least 1.")
   if args.group_id > args.group_amount:
@@ -155,13 +1221,40 @@ def validate_args(args):
                      f"the number of build groups ({args.group_amount}).")
   if args.group_id < 0:
     raise ValueError(f"The build group ID ({args.group_id}) cannot be less than zero.")
+  if args.jobs < 1:
+    raise ValueError(f"The number of jobs ({args.jobs}) should be at least 1.")
+  if args.partition == PARTITION_DURATION and not args.build_history:
+    raise ValueError(f'The "{PARTITION_DURATION}" partition requires a build history file ' + \
+                     "shared by all builders.")
+  if args.build_history and args.build_history_output and \
+     os.path.abspath(args.build_history) == os.path.abspath(args.build_history_output):
+    raise ValueError("The build history output file should not be the build history file, " + \
+                     "since all builders need to read the same history.")
   return args
 
 
 def main():
+  signal.signal(signal.SIGTERM, handle_sigterm)
   args = validate_args(args_parser().parse_args())
+  if args.validate_only:
+    validate_json(args.nixos_config_dir, args.validation_cache)
+    return
   build_dir = os.path.join(tempfile.gettempdir(), 'nix_config_build')
-  build_configs(args.nixos_config_dir, build_dir, args.group_amount, args.group_id)
+  build_configs(args.nixos_config_dir, build_dir,
+                args.group_amount, args.group_id, args.partition,
+                BuildOptions(jobs = args.jobs,
+                             batch = args.batch,
+                             history_path = args.build_history,
+                             history_output_path = args.build_history_output,
+                             cache_path = args.build_cache,
+                             hash_cache_path = args.hash_cache,
+                             force = args.force,
+                             tree_mode = args.tree_mode,
+                             validation_cache_path = args.validation_cache,
+                             report_path = args.report,
+                             log_dir = args.log_dir,
+                             retry_policies = read_retry_policies(args.retry_policies),
+                             eval_only = args.eval_only))
 
 
 if __name__ == '__main__':
@@ -2,17 +2,19 @@
 #! nix-shell -i python3 ../shell.nix
 
 import argparse
+import hashlib
 import os
+import tempfile
 import traceback
-import yaml # type: ignore
 
 from base64 import b64decode
 
-from typing import Any, Mapping
+from typing import Any, Dict, Mapping, Set
 
-from nixostools import secret_lib
+from nixostools import secret_lib, serialization_lib
 from nixostools.secret_lib import OPENSSH_PRIVATE_KEY_SIGNATURE, \
-                                  PRIVATE_KEY_LENGTH
+                                  PRIVATE_KEY_LENGTH, \
+                                  UTF8
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -28,23 +30,93 @@ def args_parser() -> argparse.ArgumentParser:
   return parser
 
 
-def do_write_file(output_path: str,
-                  secret: Mapping):
-  with open(output_path, 'w') as f:
-    f.write(secret['content'])
-    print(f"wrote {output_path}")
-
-
+# Returns the path of a temporary file containing the given content,
+# in the same directory as the output path, so that we can atomically move it in place.
+def write_temp_file(output_path: str,
+                    content: bytes) -> str:
+  (directory, name) = os.path.split(output_path)
+  # mkstemp creates the file with os.open, O_EXCL and mode 0600
+  (fd, temp_path) = tempfile.mkstemp(dir = directory, prefix = f'.{name}.', suffix = '.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(content)
+      f.flush()
+      os.fsync(f.fileno())
+  except:
+    os.unlink(temp_path)
+    raise
+  return temp_path
+
+
+def has_content(path: str,
+                content: bytes) -> bool:
+  if not os.path.isfile(path) or os.path.islink(path):
+    return False
+  with open(path, 'rb') as f:
+    return hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest()
+
+
+def fsync_directory(directory: str) -> None:
+  fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def remove_temp_file(temp_path: str) -> None:
+  try:
+    os.unlink(temp_path)
+  except FileNotFoundError:
+    pass
+
+
+# We do not touch files which already have the right content.
+# The other files are first written to temporary files, which are then moved in place,
+# so that a crash never leaves half-written secrets behind.
+# Temporary files which could not be moved in place are removed again.
+# We sync every directory only once, after moving all files in place.
 def write_files(output_path_prefix: str,
                 secrets: Mapping):
+  # When several secrets have the same path, the last one wins
+  contents: Dict[str, bytes] = {}
   for secret in secrets.values():
-    output_path = os.path.join(output_path_prefix, secret['path'])
     try:
-      do_write_file(output_path, secret)
+      output_path = os.path.join(output_path_prefix, secret['path'])
+      contents[output_path] = secret['content'].encode(UTF8)
     except:
-      print(f"ERROR : failed to write to {secret['path']}")
+      print(f"ERROR : failed to write to {secret.get('path')}")
       print(traceback.format_exc())
 
+  temp_paths: Dict[str, str] = {}
+  directories: Set[str] = set()
+  try:
+    for (output_path, content) in contents.items():
+      try:
+        if has_content(output_path, content):
+          print(f"unchanged {output_path}")
+        else:
+          temp_paths[output_path] = write_temp_file(output_path, content)
+      except:
+        print(f"ERROR : failed to write to {output_path}")
+        print(traceback.format_exc())
+
+    for (output_path, temp_path) in list(temp_paths.items()):
+      try:
+        os.replace(temp_path, output_path)
+        del temp_paths[output_path]
+        directories.add(os.path.dirname(output_path))
+        print(f"wrote {output_path}")
+      except:
+        print(f"ERROR : failed to write to {output_path}")
+        print(traceback.format_exc())
+  finally:
+    for temp_path in temp_paths.values():
+      remove_temp_file(temp_path)
+
+  for directory in directories:
+    fsync_directory(directory)
+
 
 def validate_paths(private_key_file, secrets_path, output_path):
   not_a_file_msg = 'the given path is not a file or does not exist.'
@@ -62,16 +134,15 @@ def main():
 
   with open(args.private_key_file, 'r') as f :
     server_privk = f.read()
-  with open(args.secrets_path, 'r') as f:
-    all_secrets = yaml.safe_load(f)
 
-  secrets_data = all_secrets.get(args.server_name)
+  # Only reads the secrets of this server when the file is in the indexed format
+  secrets_data = secret_lib.read_server_generated_secrets(args.secrets_path, args.server_name)
   if secrets_data:
     # decrypt the symmetric key using the server private key
     key = secret_lib.decrypt_asymmetric(secret_lib.extract_curve_private_key(server_privk),
                                         secrets_data['encrypted_key'])
     # then use it to decrypt the secrets
-    decrypted_secrets = yaml.safe_load(
+    decrypted_secrets = serialization_lib.decode_payload(
       secret_lib.decrypt_symmetric(key,
                                    secrets_data['encrypted_secrets']))
     write_files(args.output_path, decrypted_secrets)
@@ -5,20 +5,21 @@ import argparse
 import collections
 import dataclasses
 import glob
+import hashlib
+import hmac
 import json
 import os
 import traceback
-import yaml # type: ignore
 
 from base64      import b64decode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from functools   import reduce
 from getpass     import getpass
 from textwrap    import wrap
-from typing      import Any, Callable, Iterable, List, Mapping
+from typing      import Any, Callable, Dict, Iterable, List, Mapping, Optional
 from nacl.public import PublicKey # type: ignore
 
-from nixostools import ansible_vault_lib, secret_lib, ocb_nixos_lib
+from nixostools import ansible_vault_lib, fleet_lib, secret_lib, serialization_lib, ocb_nixos_lib
 
 from nixostools.secret_lib import OPENSSH_PUBLIC_KEY_STRING_LENGTH, \
                                   OPENSSH_PUBLIC_KEY_SIGNATURE, \
@@ -27,7 +28,12 @@ from nixostools.secret_lib import OPENSSH_PUBLIC_KEY_STRING_LENGTH, \
                                   SERVERS_KEY, \
                                   PATH_KEY, \
                                   CONTENT_KEY, \
+                                  OUTPUT_FORMAT_YAML, \
+                                  OUTPUT_FORMAT_INDEXED, \
                                   UTF8
+from nixostools.fleet_lib import FleetIndex
+from nixostools.serialization_lib import PAYLOAD_FORMAT_YAML, \
+                                         PAYLOAD_FORMATS
 
 
 @dataclass(frozen=True)
@@ -35,19 +41,26 @@ class ServerSecretData:
   server_name: str
   secrets: Mapping
 
-  def str_secrets(self) -> str:
-    return yaml.safe_dump(self.secrets) # type: ignore
+  def str_secrets(self, payload_format: str = PAYLOAD_FORMAT_YAML) -> str:
+    return serialization_lib.encode_payload(self.secrets, payload_format)
 
+  def encoded_secrets(self, payload_format: str = PAYLOAD_FORMAT_YAML) -> bytes:
+    return self.str_secrets(payload_format).encode(UTF8)
+
+# We have one of these for every server, and the padded secrets are large,
+# so we avoid the per-instance dict.
 @dataclass(frozen=True)
 class PaddedServerSecretData:
+  __slots__ = ('server_name', 'padded_secrets')
   server_name: str
-  padded_secrets: str
+  padded_secrets: bytes
 
 @dataclass(frozen=True)
 class EncryptedSecrets:
   server_name: str
   encrypted_key: str
   encrypted_secrets: str
+  fingerprint: str
 
   def export_secrets(self) -> Mapping[str,str]:
     server_name = 'server_name'
@@ -69,6 +82,29 @@ def args_parser() -> argparse.ArgumentParser:
   parser.add_argument("--secrets_directory", dest="secrets_directory", required=True, type=str,
                       help="The directory containing the *-secrets.yml files, encrypted with Ansible Vault")
   parser.add_argument('--tunnel_config_path', dest = 'tunnel_config_path', required = True)
+  parser.add_argument("--jobs", dest="jobs", required=False, type=int,
+                      help="the number of processes or threads to use, defaults to the number of CPUs")
+  parser.add_argument("--json_cache", dest="json_cache", required=False, type=str,
+                      default=os.path.join(ocb_nixos_lib.cache_dir(), 'json_configs_cache.json'),
+                      help="the JSON file in which we cache the merged tunnel config")
+  parser.add_argument("--fleet_index", dest="fleet_index", required=False, type=str,
+                      default=os.path.join(ocb_nixos_lib.cache_dir(), 'fleet_index.bin'),
+                      help="the file in which we keep a snapshot of the parsed hosts of the tunnel config")
+  parser.add_argument("--key_cache", dest="key_cache", required=False, type=str,
+                      default=os.path.join(ocb_nixos_lib.cache_dir(), 'public_key_cache.json'),
+                      help="the JSON file in which we cache the conversion of the public keys of the servers")
+  parser.add_argument("--output_format", dest="output_format", required=False, type=str,
+                      choices=[ OUTPUT_FORMAT_YAML, OUTPUT_FORMAT_INDEXED ], default=OUTPUT_FORMAT_YAML,
+                      help="the format of the generated secrets file, the indexed format allows every server " +
+                           "to read only its own secrets, only use indexed when all servers run a version which can read it " +
+                           "(default: yaml)")
+  parser.add_argument("--payload_format", dest="payload_format", required=False, type=str,
+                      choices=PAYLOAD_FORMATS, default=PAYLOAD_FORMAT_YAML,
+                      help="the format of the secrets inside the encrypted payload of every server, " +
+                           "only use json when all servers run a version which can decode it (default: yaml)")
+  parser.add_argument("--incremental", dest="incremental", action="store_true",
+                      help="only encrypt the secrets again for servers whose secrets or public key changed, " +
+                           "and keep the existing encrypted secrets for the other servers")
   return parser
 
 
@@ -88,37 +124,63 @@ def get_secrets(secrets) -> Iterable[ServerSecretData]:
     return { k:v for k,v in secret.items()
                  if k in whitelist }
 
-  # Build a mapping from every server to its secrets
-  def reducer(server_dict: Mapping[str, ServerSecretData],
-              secret_item) -> Mapping[str, ServerSecretData]:
-    (secret_name, secret) = secret_item
+  # Build a mapping from every server to its secrets.
+  # We fill in the dicts in place, so that this stays linear in the number of
+  # (secret, server) pairs, even for large numbers of secrets and servers.
+  server_secrets: Dict[str, Dict[str, Mapping]] = {}
+  for (secret_name, secret) in secrets.get(SECRETS_KEY, {}).items():
     validate_secret(secret_name, secret)
-    out = { **server_dict }
+    filtered_secret = filter_secret(secret)
     for server in secret.get(SERVERS_KEY, []):
-      existing_secrets = out[server].secrets if server in out else {}
-      out[server] = ServerSecretData(server_name = server,
-                                     secrets = { **existing_secrets,
-                                                 secret_name: filter_secret(secret)})
-    return out
+      server_secrets.setdefault(server, {})[secret_name] = filtered_secret
 
-  init: Mapping[str, ServerSecretData] = {}
-  return reduce(reducer, secrets.get(SECRETS_KEY, {}).items(), init).values()
+  return [ ServerSecretData(server_name = server, secrets = server_secret_data)
+           for (server, server_secret_data) in server_secrets.items() ]
 
 
 def encrypt_data(data: PaddedServerSecretData,
-                 pubkey: PublicKey) -> EncryptedSecrets:
+                 pubkey: PublicKey,
+                 fingerprint: str) -> EncryptedSecrets:
   # Encrypt the secrets with a new key generated on the fly.
   # Only short, random data should ever by encrypted with a public key.
   new_key = secret_lib.generate_symmetric_key()
-  encrypted_secrets = secret_lib.encrypt_symmetric_string(new_key,
-                                                          data.padded_secrets)
+  encrypted_secrets = secret_lib.encrypt_symmetric(new_key,
+                                                   data.padded_secrets)
 
   # Encrypt the newly generated key using the server's public key.
   encrypted_key = secret_lib.encrypt_asymmetric(pubkey, new_key)
 
   return EncryptedSecrets(server_name = data.server_name,
                           encrypted_key = encrypted_key,
-                          encrypted_secrets = encrypted_secrets)
+                          encrypted_secrets = encrypted_secrets,
+                          fingerprint = fingerprint)
+
+
+# To know whether the secrets of a server changed since the last run,
+# we store a fingerprint of the padded plaintext and the public key of the server
+# next to its encrypted secrets.
+# The fingerprint is an HMAC with a key derived from the vault password,
+# so that it cannot be used to guess the plaintext without knowing the password.
+FINGERPRINT_KEY_SALT = b"nixostools-generated-secrets-fingerprint"
+
+def derive_fingerprint_key(ansible_passwd: str) -> bytes:
+  return hashlib.pbkdf2_hmac('sha256', ansible_passwd.encode(UTF8), FINGERPRINT_KEY_SALT, 100000)
+
+
+def fingerprint_secrets(fingerprint_key: bytes,
+                        data: PaddedServerSecretData,
+                        pubkey: PublicKey) -> str:
+  fingerprint = hmac.new(fingerprint_key, digestmod = hashlib.sha256)
+  fingerprint.update(bytes(pubkey))
+  fingerprint.update(data.padded_secrets)
+  return fingerprint.hexdigest()
+
+
+def read_generated_secrets(output_path: str) -> Mapping[str, Mapping]:
+  if not os.path.isfile(output_path):
+    return {}
+  generated_secrets = secret_lib.read_generated_secrets(output_path)
+  return generated_secrets if isinstance(generated_secrets, dict) else {}
 
 
 # The only information still communicated by the ciphertext,
@@ -127,7 +189,8 @@ def encrypt_data(data: PaddedServerSecretData,
 # we pad the plaintexts with newlines such that they all have equal length.
 # It is important to look at the length in bytes, rather than
 # the length in characters, to account for variable-width encoding.
-def pad_secrets(data: List[ServerSecretData]) -> Iterable[PaddedServerSecretData]:
+def pad_secrets(data: List[ServerSecretData],
+                payload_format: str = PAYLOAD_FORMAT_YAML) -> Iterable[PaddedServerSecretData]:
   # We round the max length up to the nearest 10**exp
   # So for instance, for exp = 3, 24869 -> 25000
   # Upper is the part > 10**exp, so for our example
@@ -144,26 +207,32 @@ def pad_secrets(data: List[ServerSecretData]) -> Iterable[PaddedServerSecretData
     else:
       return i
 
-  def reducer(length: int, data: ServerSecretData) -> int:
-    return max(length, len(data.str_secrets().encode(UTF8)))
+  # We serialize the secrets of every server only once,
+  # and we pad the encoded bytes, so that the lengths are equal in bytes.
+  encoded_secrets = [ (secret_data.server_name, secret_data.encoded_secrets(payload_format))
+                      for secret_data in data ]
 
-  padding_len = round_up(reduce(reducer, data, 0))
+  padding_len = round_up(max((len(secrets) for (_, secrets) in encoded_secrets), default = 0))
 
-  pad = lambda secrets: secrets.ljust(padding_len, '\n')
-  return [ PaddedServerSecretData(server_name = secret_data.server_name,
-                                  padded_secrets = pad(secret_data.str_secrets()))
-           for secret_data in data ]
+  return [ PaddedServerSecretData(server_name = server_name,
+                                  padded_secrets = secrets.ljust(padding_len, b'\n'))
+           for (server_name, secrets) in encoded_secrets ]
 
 
 def write_secrets(encrypted_secrets_list: List[EncryptedSecrets],
-                  output_path: str) -> bool:
+                  output_path: str,
+                  output_format: str = OUTPUT_FORMAT_YAML) -> bool:
   print(f'Writing generated secrets to {output_path}...')
   content = { encrypted_secrets.server_name: encrypted_secrets.export_secrets()
               for encrypted_secrets in encrypted_secrets_list }
 
   try:
-    with open(output_path, 'w') as f:
-      yaml.safe_dump(content, f, default_style='|')
+    if output_format == OUTPUT_FORMAT_INDEXED:
+      with open(output_path, 'wb') as fb:
+        secret_lib.write_indexed_secrets(fb, content)
+    else:
+      with open(output_path, 'w') as f:
+        serialization_lib.yaml_dump(content, f, default_style='|')
   except:
     print(f'ERROR : failed to write generated secrets file')
     print(traceback.format_exc())
@@ -172,48 +241,81 @@ def write_secrets(encrypted_secrets_list: List[EncryptedSecrets],
   return True
 
 
-def read_secrets_files(secrets_files: Iterable[str], ansible_passwd: str) -> Mapping:
-  def reducer(secrets_data: Mapping, secrets_file: str) -> Mapping:
+# Decrypting a vault file is expensive, because of the key derivation,
+# so we decrypt and parse the files in parallel.
+# The files are merged in sorted order, so that the result does not depend
+# on the order in which the files were listed or decrypted.
+def read_secrets_files(secrets_files: Iterable[str],
+                       ansible_passwd: str,
+                       jobs: Optional[int] = None) -> Mapping:
+  secrets_files = sorted(secrets_files)
+  print(f"Decrypting {len(secrets_files)} secrets files...")
+  with ProcessPoolExecutor(max_workers = jobs) as executor:
+    decrypted_files = list(zip(secrets_files,
+                               executor.map(ansible_vault_lib.read_vault_file,
+                                            [ ansible_passwd ] * len(secrets_files),
+                                            secrets_files)))
+
+  # We keep track of the files defining every secret while merging,
+  # so that we can report all duplicates without decrypting the files again.
+  secrets_index: Dict[str, List[str]] = collections.defaultdict(list)
+  secrets_data: Mapping = { SECRETS_KEY: {} }
+  for (secrets_file, new_secrets) in decrypted_files:
     print(f"Parsing {secrets_file}...")
-    new_secrets = ansible_vault_lib.read_vault_file(ansible_passwd, secrets_file)
-
-    # If we detect a duplicate secret, we run our more expensive method to list all duplicates
-    if set(secrets_data.get(SECRETS_KEY, {}).keys()).intersection(
-            set(new_secrets.get(SECRETS_KEY, {}).keys())):
-      check_duplicate_secrets(secrets_files, ansible_passwd)
-      raise AssertionError("Duplicate secrets found, see above.")
-
-    return ocb_nixos_lib.deep_merge(secrets_data, new_secrets)
-
-  init: Mapping = { SECRETS_KEY: {} }
-  return reduce(reducer, secrets_files, init)
-
-
-def check_duplicate_secrets(secrets_files: Iterable[str], ansible_passwd: str) -> None:
-  print(f"Finding duplicates...")
-  def build_secrets_mapping(secrets_data: Mapping, secrets_file: str) -> Mapping:
-    new_secrets = ansible_vault_lib.read_vault_file(ansible_passwd, secrets_file)
-
-    # Make a mapping of every secret to the files defining a secret with that name
-    secrets = { **secrets_data }
-    for secret in new_secrets.get(SECRETS_KEY, {}).keys():
-      files_found = secrets.get(secret, [])
-      secrets[secret] = files_found + [secrets_file]
-
-    return secrets
-
-  secret: str
-  files: Iterable[str]
-  init: Mapping = {}
-  for (secret, files) in reduce(build_secrets_mapping, secrets_files, init).items():
-    if len(list(files)) > 1:
-      print(f"ERROR: secret with name '{secret}' is defined in multiple files: {', '.join(files)}")
-
-
-def is_active_secret(tunnels_json: Mapping) -> Callable[[ServerSecretData], bool]:
+    new_secret_names = new_secrets.get(SECRETS_KEY, {}).keys()
+    for secret in new_secret_names:
+      secrets_index[secret].append(secrets_file)
+    if all(len(secrets_index[secret]) == 1 for secret in new_secret_names):
+      secrets_data = ocb_nixos_lib.deep_merge(secrets_data, new_secrets)
+
+  check_duplicate_secrets(secrets_index)
+  return secrets_data
+
+
+def check_duplicate_secrets(secrets_index: Mapping[str, List[str]]) -> None:
+  duplicates = { secret: files for (secret, files) in secrets_index.items() if len(files) > 1 }
+  for (secret, files) in sorted(duplicates.items()):
+    print(f"ERROR: secret with name '{secret}' is defined in multiple files: {', '.join(files)}")
+  if duplicates:
+    raise AssertionError("Duplicate secrets found, see above.")
+
+
+# The encryption is done by libsodium, which releases the GIL,
+# so we encrypt the secrets of the different servers in parallel threads.
+# The results are returned in the same order as the given secrets.
+# The existing encrypted secrets of a server are kept when their fingerprint did not change.
+def encrypt_server_secrets(padded_secrets: Iterable[PaddedServerSecretData],
+                           fleet_index: FleetIndex,
+                           tunnel_config_path: str,
+                           fingerprint_key: bytes,
+                           existing_secrets: Mapping[str, Mapping] = {},
+                           jobs: Optional[int] = None) -> List[EncryptedSecrets]:
+  def encrypt_server(secrets: PaddedServerSecretData) -> Optional[EncryptedSecrets]:
+    pub_key = fleet_index.curve_public_key(secrets.server_name, tunnel_config_path)
+    # pub_key is None when the public_key field is empty
+    # this happens when we are provisioning servers
+    if not pub_key:
+      return None
+
+    fingerprint = fingerprint_secrets(fingerprint_key, secrets, pub_key)
+    existing = existing_secrets.get(secrets.server_name, {})
+    if existing.get('fingerprint') and hmac.compare_digest(existing['fingerprint'], fingerprint):
+      return EncryptedSecrets(server_name = secrets.server_name,
+                              encrypted_key = existing['encrypted_key'],
+                              encrypted_secrets = existing['encrypted_secrets'],
+                              fingerprint = fingerprint)
+    print(f"Encrypting the secrets for {secrets.server_name}...")
+    return encrypt_data(secrets, pub_key, fingerprint)
+
+  with ThreadPoolExecutor(max_workers = jobs) as executor:
+    return [ encrypted_secrets
+             for encrypted_secrets in executor.map(encrypt_server, padded_secrets)
+             if encrypted_secrets ]
+
+
+def is_active_secret(fleet_index: FleetIndex) -> Callable[[ServerSecretData], bool]:
   def wrapped(data: ServerSecretData) -> bool:
-    return bool(tunnels_json['tunnels']['per-host'].get(data.server_name, {})
-                                                   .get('generate_secrets', True))
+    return fleet_index.is_active(data.server_name)
   return wrapped
 
 
@@ -222,27 +324,31 @@ def main() -> None:
 
   # First, we fetch and load the secrets data
   secrets_files = glob.glob(os.path.join(args.secrets_directory, '*-secrets.yml'))
-  secrets_dict = read_secrets_files(secrets_files,
-                                    ansible_vault_lib.get_ansible_passwd(args.ansible_vault_passwd))
+  ansible_passwd = ansible_vault_lib.get_ansible_passwd(args.ansible_vault_passwd)
+  secrets_dict = read_secrets_files(secrets_files, ansible_passwd, args.jobs)
 
-  tunnels_json = ocb_nixos_lib.read_json_configs(args.tunnel_config_path)
+  fleet_index = fleet_lib.load_fleet_index(args.tunnel_config_path,
+                                           args.fleet_index,
+                                           args.json_cache,
+                                           args.key_cache,
+                                           args.jobs)
 
   secrets = get_secrets(secrets_dict)
   # An iterator can only be consumed once,
   # so we transform it into a list before passing it along
-  active_secrets = list(filter(is_active_secret(tunnels_json), secrets))
-  padded_secrets = pad_secrets(active_secrets)
-
-  write_secrets([ encrypt_data(secrets, pub_key)
-                  for secrets in padded_secrets
-                  for pub_key in [ secret_lib.extract_public_key(tunnels_json,
-                                                                 secrets.server_name,
-                                                                 args.tunnel_config_path) ]
-                  # pub_key is None when the public_key field is empty
-                  # this happens when we are provisioning servers
-                  if pub_key ],
-                args.output_path)
-
+  active_secrets = list(filter(is_active_secret(fleet_index), secrets))
+  padded_secrets = pad_secrets(active_secrets, args.payload_format)
+
+  existing_secrets = read_generated_secrets(args.output_path) if args.incremental else {}
+
+  write_secrets(encrypt_server_secrets(padded_secrets,
+                                       fleet_index,
+                                       args.tunnel_config_path,
+                                       derive_fingerprint_key(ansible_passwd),
+                                       existing_secrets,
+                                       args.jobs),
+                args.output_path,
+                args.output_format)
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,234 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from dataclasses import dataclass
+from typing      import Dict, Iterator, Mapping, Optional, Tuple
+
+from nacl.public import PublicKey # type: ignore
+
+from nixostools import ocb_nixos_lib, secret_lib
+from nixostools.secret_lib import TUNNELS_KEY, \
+                                  PER_HOST_KEY, \
+                                  PUBLIC_KEY_KEY, \
+                                  UTF8
+
+
+GENERATE_SECRETS_KEY = "generate_secrets"
+
+
+# What we need to know about every host of the fleet, with its public key parsed only once.
+# The key bytes are None when the host has no public key (yet),
+# or when its public key could not be parsed, in which case key_error says why.
+@dataclass(frozen=True)
+class HostRecord:
+  __slots__ = ('name', 'public_key', 'generate_secrets', 'ed25519_key', 'curve25519_key', 'key_error')
+  name: str
+  public_key: str
+  generate_secrets: bool
+  ed25519_key: Optional[bytes]
+  curve25519_key: Optional[bytes]
+  key_error: Optional[str]
+
+  # The converted key bytes can be given when they were already converted in a batch
+  @staticmethod
+  def from_config(name: str,
+                  host_config: Mapping,
+                  converted_key: Optional[Tuple[bytes, bytes]] = None) -> "HostRecord":
+    public_key = host_config.get(PUBLIC_KEY_KEY) or ''
+    (ed25519_key, curve25519_key, key_error) = (None, None, None)
+    if converted_key:
+      (ed25519_key, curve25519_key) = converted_key
+    elif public_key.strip():
+      try:
+        (ed25519_key, curve25519_key) = secret_lib.convert_public_key(
+                                          secret_lib.openssh_public_key_chars(public_key, name))
+      except Exception as e:
+        key_error = str(e) or type(e).__name__
+    return HostRecord(name = name,
+                      public_key = public_key,
+                      generate_secrets = bool(host_config.get(GENERATE_SECRETS_KEY, True)),
+                      ed25519_key = ed25519_key,
+                      curve25519_key = curve25519_key,
+                      key_error = key_error)
+
+  # Returns None when the host has an empty public key,
+  # this happens for servers being provisioned.
+  def curve_public_key(self) -> Optional[PublicKey]:
+    if self.key_error:
+      # The message already names the server
+      raise Exception(self.key_error)
+    return PublicKey(self.curve25519_key) if self.curve25519_key else None
+
+
+# The binary snapshot of a fleet index consists of a header, containing a magic string,
+# a digest of the inputs and the number of hosts, followed by one record for every host.
+# Every record starts with the lengths of its fields, followed by the fields themselves.
+# The magic string is part of the digest, bump its version whenever the format
+# or the parsing of the public keys changes, so that older snapshots are not used.
+SNAPSHOT_MAGIC  = b"NXFLEET2"
+SNAPSHOT_HEADER = struct.Struct("<8s32sI")
+SNAPSHOT_RECORD = struct.Struct("<HHHB")
+KEY_BYTES_LENGTH = 32
+
+FLAG_GENERATE_SECRETS = 1
+FLAG_HAS_KEY          = 2
+
+
+def encode_record(record: HostRecord) -> bytes:
+  name = record.name.encode(UTF8)
+  public_key = record.public_key.encode(UTF8)
+  key_error = (record.key_error or '').encode(UTF8)
+  flags = (FLAG_GENERATE_SECRETS if record.generate_secrets else 0) | \
+          (FLAG_HAS_KEY if record.ed25519_key and record.curve25519_key else 0)
+  keys = (record.ed25519_key or b'') + (record.curve25519_key or b'') if flags & FLAG_HAS_KEY else b''
+  return SNAPSHOT_RECORD.pack(len(name), len(public_key), len(key_error), flags) + \
+         name + public_key + key_error + keys
+
+
+def decode_record(buffer: mmap.mmap, offset: int) -> Tuple[HostRecord, int]:
+  (name_len, public_key_len, key_error_len, flags) = SNAPSHOT_RECORD.unpack_from(buffer, offset)
+  offset += SNAPSHOT_RECORD.size
+  def take(length: int) -> bytes:
+    nonlocal offset
+    value = buffer[offset:offset+length]
+    offset += length
+    return value
+  name = take(name_len).decode(UTF8)
+  public_key = take(public_key_len).decode(UTF8)
+  key_error = take(key_error_len).decode(UTF8)
+  (ed25519_key, curve25519_key) = (take(KEY_BYTES_LENGTH), take(KEY_BYTES_LENGTH)) \
+                                  if flags & FLAG_HAS_KEY else (None, None)
+  record = HostRecord(name = name,
+                      public_key = public_key,
+                      generate_secrets = bool(flags & FLAG_GENERATE_SECRETS),
+                      ed25519_key = ed25519_key,
+                      curve25519_key = curve25519_key,
+                      key_error = key_error or None)
+  return (record, offset)
+
+
+# Mapping from the name of every host in the tunnel config to its HostRecord.
+# An index read from a snapshot only decodes the records which are accessed.
+class FleetIndex(Mapping[str, HostRecord]):
+  def __init__(self,
+               records: Dict[str, HostRecord],
+               buffer: Optional[mmap.mmap] = None,
+               offsets: Mapping[str, int] = {}) -> None:
+    self.records = records
+    self.buffer = buffer
+    self.offsets = offsets
+
+  @staticmethod
+  def from_configs(tunnels_json: Mapping,
+                   key_cache_path: Optional[str] = None) -> "FleetIndex":
+    host_configs = tunnels_json[TUNNELS_KEY][PER_HOST_KEY]
+
+    # We convert all well-formed keys in one batch,
+    # the records of the other hosts will get the parsing error.
+    key_strings: Dict[str, str] = {}
+    for (name, host_config) in host_configs.items():
+      public_key = host_config.get(PUBLIC_KEY_KEY) or ''
+      try:
+        if public_key.strip():
+          key_strings[name] = secret_lib.openssh_public_key_chars(public_key, name)
+      except Exception:
+        pass
+    converted_keys = secret_lib.convert_public_keys(key_strings.values(), key_cache_path)
+
+    return FleetIndex({ name: HostRecord.from_config(name,
+                                                     host_config,
+                                                     converted_keys.get(key_strings.get(name, '')))
+                        for (name, host_config) in host_configs.items() })
+
+  def __getitem__(self, name: str) -> HostRecord:
+    if name not in self.records:
+      if self.buffer is None or name not in self.offsets:
+        raise KeyError(name)
+      (self.records[name], _) = decode_record(self.buffer, self.offsets[name])
+    return self.records[name]
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.offsets if self.buffer is not None else self.records)
+
+  def __len__(self) -> int:
+    return len(self.offsets if self.buffer is not None else self.records)
+
+  def is_active(self, name: str) -> bool:
+    record = self.get(name)
+    return record.generate_secrets if record else True
+
+  def curve_public_key(self, name: str, tunnel_config_path: str) -> Optional[PublicKey]:
+    record = self.get(name)
+    if not record:
+      raise Exception(f'Server {name} not found in "{tunnel_config_path}".')
+    return record.curve_public_key()
+
+  def write_snapshot(self, snapshot_path: str, digest: bytes) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok = True)
+    tmp_path = f'{snapshot_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, digest, len(self)))
+      for name in self:
+        f.write(encode_record(self[name]))
+    os.replace(tmp_path, snapshot_path)
+
+  # Returns None when there is no valid snapshot for the given digest
+  @staticmethod
+  def read_snapshot(snapshot_path: str, digest: bytes) -> Optional["FleetIndex"]:
+    try:
+      with open(snapshot_path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+      return None
+
+    try:
+      (magic, snapshot_digest, count) = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+      if magic != SNAPSHOT_MAGIC or snapshot_digest != digest:
+        buffer.close()
+        return None
+      # We only read the names to find the records, we decode the records when accessed
+      offsets: Dict[str, int] = {}
+      offset = SNAPSHOT_HEADER.size
+      for _ in range(count):
+        (name_len, public_key_len, key_error_len, flags) = SNAPSHOT_RECORD.unpack_from(buffer, offset)
+        name_start = offset + SNAPSHOT_RECORD.size
+        offsets[buffer[name_start:name_start+name_len].decode(UTF8)] = offset
+        offset = name_start + name_len + public_key_len + key_error_len + \
+                 (2 * KEY_BYTES_LENGTH if flags & FLAG_HAS_KEY else 0)
+    except (struct.error, UnicodeDecodeError):
+      buffer.close()
+      return None
+    return FleetIndex({}, buffer, offsets)
+
+
+# Digest of the paths and the contents of the JSON files making up the tunnel config,
+# a snapshot is only used when the digest did not change.
+# We hash the contents every time, since the snapshot holds the keys we encrypt to,
+# and a changed file can keep its size and mtime (cp -p, rsync -t, touch -r).
+# Hashing is cheap compared to parsing the files and converting the keys.
+def inputs_digest(tunnel_config_path: str) -> bytes:
+  digest = hashlib.sha256(SNAPSHOT_MAGIC)
+  for f in ocb_nixos_lib.json_config_files(tunnel_config_path):
+    digest.update(f"{f}\0{ocb_nixos_lib.hash_json_file(f)}\n".encode(UTF8))
+  return digest.digest()
+
+
+def load_fleet_index(tunnel_config_path: str,
+                     snapshot_path: Optional[str],
+                     json_cache_path: Optional[str] = None,
+                     key_cache_path: Optional[str] = None,
+                     jobs: Optional[int] = None) -> FleetIndex:
+  digest = inputs_digest(tunnel_config_path)
+  if snapshot_path:
+    fleet_index = FleetIndex.read_snapshot(snapshot_path, digest)
+    if fleet_index is not None:
+      return fleet_index
+
+  fleet_index = FleetIndex.from_configs(
+                  ocb_nixos_lib.load_json_configs(tunnel_config_path, json_cache_path, jobs),
+                  key_cache_path)
+  if snapshot_path:
+    fleet_index.write_snapshot(snapshot_path, digest)
+  return fleet_index
@@ -1,51 +1,244 @@
 
+import hashlib
 import json
 import os
 import os.path
 
-from functools import reduce
-from typing import Dict, List, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+
+# Directory in which our tools can keep state between runs,
+# following the XDG base directory specification.
+def cache_dir() -> str:
+  xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or \
+                   os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(xdg_cache_home, 'nixostools')
+
+
+# Read a JSON file in which a tool keeps state between runs,
+# a missing or corrupt file is treated as an empty state.
+def read_json_state(state_path: str) -> Dict:
+  try:
+    with open(state_path, 'r') as f:
+      state = json.load(f)
+    return state if isinstance(state, dict) else {}
+  except (FileNotFoundError, ValueError):
+    return {}
+
+
+# Write the state to a temporary file first and move it in place afterwards,
+# so that we never leave a corrupt state file behind.
+def write_json_state(state_path: str, state: Mapping) -> None:
+  os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok = True)
+  tmp_path = f'{state_path}.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(state, f, indent = 2, sort_keys = True)
+  os.replace(tmp_path, state_path)
 
 
 def read_json_configs(config_path: str) -> Mapping:
   if os.path.isfile(config_path):
     with open(config_path, 'r') as f:
       return json.load(f) # type: ignore
+  else:
+    return deep_merge_all([ read_json_configs(f) for f in json_config_files(config_path) ])
+
+
+def json_config_files(config_path: str) -> List[str]:
+  if os.path.isfile(config_path):
+    return [ os.path.abspath(config_path) ]
   elif os.path.isdir(config_path):
-    json_configs = [ read_json_configs(f.path)
-                     for f in os.scandir(config_path)
-                     if f.is_file() and os.path.splitext(f.name)[1] == '.json' ]
-    return reduce(deep_merge, json_configs, {})
+    return [ os.path.abspath(f.path)
+             for f in sorted(os.scandir(config_path), key = lambda f: f.name)
+             if f.is_file() and os.path.splitext(f.name)[1] == '.json' ]
   else:
     raise FileNotFoundError(f'The given config path ({config_path}) does not exist!')
 
 
+def read_json_file(path: str) -> Tuple[str, Any]:
+  with open(path, 'rb') as f:
+    content = f.read()
+  return (hashlib.sha256(content).hexdigest(), json.loads(content))
+
+
+def hash_json_file(path: str) -> str:
+  with open(path, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+# Path to the per-host configs in the merged configs.
+# In the cache, we keep every per-host config as a separate JSON string,
+# which we only decode when that host is accessed.
+PER_HOST_PATH = ('tunnels', 'per-host')
+
+
+class LazyPerHostConfigs(Mapping):
+  def __init__(self, encoded_configs: Mapping[str, str]) -> None:
+    self.encoded_configs = encoded_configs
+    self.decoded_configs: Dict[str, Any] = {}
+
+  def __getitem__(self, host: str) -> Any:
+    if host not in self.decoded_configs:
+      self.decoded_configs[host] = json.loads(self.encoded_configs[host])
+    return self.decoded_configs[host]
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self.encoded_configs)
+
+  def __len__(self) -> int:
+    return len(self.encoded_configs)
+
+
+def encode_cached_configs(configs: Mapping) -> Mapping:
+  (parent_key, per_host_key) = PER_HOST_PATH
+  parent = configs.get(parent_key)
+  if not (isinstance(parent, Mapping) and isinstance(parent.get(per_host_key), Mapping)):
+    return { 'configs': configs, 'per_host': None }
+  return {
+    'configs':  { **configs, parent_key: { k: v for (k, v) in parent.items() if k != per_host_key } },
+    'per_host': { host: json.dumps(host_config) for (host, host_config) in parent[per_host_key].items() }
+  }
+
+
+def decode_cached_configs(cached: Mapping) -> Mapping:
+  configs = cached['configs']
+  if cached['per_host'] is None:
+    return configs # type: ignore
+  (parent_key, per_host_key) = PER_HOST_PATH
+  return { **configs,
+           parent_key: { **configs[parent_key],
+                         per_host_key: LazyPerHostConfigs(cached['per_host']) } }
+
+
+# Like read_json_configs, but we keep the merged configs in a cache,
+# keyed on the path, size, mtime and hash of every JSON file.
+# We only hash the files whose size or mtime changed, and we only parse the files
+# again, in parallel, when any of the hashes changed.
+# The per-host configs coming from the cache are only decoded when accessed.
+def load_json_configs(config_path: str,
+                      cache_path: Optional[str],
+                      jobs: Optional[int] = None) -> Mapping:
+  files = json_config_files(config_path)
+  stats = { f: os.stat(f) for f in files }
+
+  cache = read_json_state(cache_path) if cache_path else {}
+  cached = cache.get(os.path.abspath(config_path), {})
+  cached_inputs = cached.get('inputs', {})
+
+  def input_entry(f: str, content_hash: str) -> Dict:
+    return { 'size': stats[f].st_size, 'mtime_ns': stats[f].st_mtime_ns, 'sha256': content_hash }
+
+  def is_touched(f: str) -> bool:
+    cached_input = cached_inputs.get(f, {})
+    return (cached_input.get('size'), cached_input.get('mtime_ns')) != \
+           (stats[f].st_size, stats[f].st_mtime_ns)
+
+  if cached and sorted(cached_inputs.keys()) == files:
+    touched = [ f for f in files if is_touched(f) ]
+    if all(cached_inputs[f].get('sha256') == hash_json_file(f) for f in touched):
+      # Files whose size or mtime changed, but not their content (e.g. after a fresh checkout),
+      # get their new size and mtime in the cache, so that we do not hash them again next time.
+      if touched and cache_path:
+        write_json_state(cache_path, {
+          **cache,
+          os.path.abspath(config_path): {
+            **cached,
+            'inputs': { **cached_inputs,
+                        **{ f: input_entry(f, cached_inputs[f]['sha256']) for f in touched } }
+          }
+        })
+      return decode_cached_configs(cached)
+
+  print(f"Reading {len(files)} JSON files from {config_path}...")
+  with ProcessPoolExecutor(max_workers = jobs) as executor:
+    results = list(executor.map(read_json_file, files, chunksize = 16))
+  configs = deep_merge_all([ config for (_, config) in results ])
+
+  if cache_path:
+    inputs = { f: input_entry(f, content_hash) for (f, (content_hash, _)) in zip(files, results) }
+    write_json_state(cache_path, {
+      **cache,
+      os.path.abspath(config_path): { 'inputs': inputs, **encode_cached_configs(configs) }
+    })
+  return configs
+
+
 def deep_merge(d1: Mapping, d2: Mapping) -> Mapping:
+  return deep_merge_all([ d1, d2 ])
+
+
+# Merge all given mappings in a single pass, without recursion.
+# Mappings are merged key by key, lists are concatenated and values which are
+# None in both mappings stay None, all other values present in both mappings
+# are a conflict.
+# As before, a falsy value (0, '', [], {}, ...) becomes None when a later mapping
+# merges into the mapping containing it, without that key, so that it merges
+# with a None in yet another mapping. We keep the keys holding such values
+# to avoid going over all keys of the output for every mapping.
+# We build the output in place. Values present in a single mapping are used
+# as they are, they only get copied when we need to merge something into them,
+# so that we never modify the given mappings.
+def deep_merge_all(mappings: Iterable[Mapping]) -> Dict:
   out: Dict = {}
+  # The ids of the containers which we created and which we can thus modify
+  owned = { id(out) }
+  # The keys with a falsy value which is not None, by id of the owned mapping
+  falsy_keys: Dict[int, Set] = { id(out): set() }
 
-  for key in set(d1.keys()).union(set(d2.keys())):
-    if key in d1 and key in d2 and \
-       not (isinstance(d1[key], type(d2[key])) or \
-            isinstance(d2[key], type(d1[key]))):
-      raise AssertionError(f"The types of the values for key '{key}' are not the same!")
-
-    # If the key is only present in one of the mappings, we use that value
-    if not (key in d1 and key in d2):
-      out[key] = d1.get(key, None) or d2.get(key, None)
-    # Otherwise, if the key maps to a mapping, we merge those mappings
-    elif isinstance(d1.get(key, None) or d2.get(key, None), Mapping):
-      out[key] = deep_merge(d1.get(key, {}), d2.get(key, {}))
-    # Otherwise, if the key maps to a list, we concat the lists
-    # (careful, str is a subset of Iterable!)
-    elif isinstance(d1.get(key, None) or d2.get(key, None), List):
-      out[key] = d1.get(key, []) + d2.get(key, [])
-    # If the key is present in both, but is twice None, then we can merge to None
-    elif d1.get(key, None) is None and d2.get(key, None) is None:
-      out[key] = None
-    # In other cases, we do not know what to do...
-    else:
-      raise ValueError(f"Unmergeable type found during merge, key: '{key}', " +
-                       f"type: '{type(d1.get(key, None) or d2.get(key, None))}'")
+  def is_falsy(value: Any) -> bool:
+    return value is not None and not value
 
-  return out
+  def owned_copy(target: Dict, key: Any, value: Any) -> Any:
+    if id(value) not in owned:
+      if isinstance(value, Mapping):
+        value = dict(value)
+        falsy_keys[id(value)] = { k for (k, v) in value.items() if is_falsy(v) }
+      else:
+        value = list(value)
+      target[key] = value
+      owned.add(id(value))
+    return value
 
+  for mapping in mappings:
+    stack: List[Tuple[Dict, Mapping, Tuple]] = [ (out, mapping, ()) ]
+    while stack:
+      (target, source, path) = stack.pop()
+      target_falsy_keys = falsy_keys[id(target)]
+      for key in [ k for k in target_falsy_keys if k not in source ]:
+        target[key] = None
+        target_falsy_keys.discard(key)
+
+      for (key, value) in source.items():
+        # If the key is only present in one of the mappings, we use that value
+        if key not in target:
+          target[key] = value
+          if is_falsy(value):
+            target_falsy_keys.add(key)
+          continue
+
+        existing = target[key]
+        key_path = '.'.join(map(str, path + (key,)))
+        if not (isinstance(existing, type(value)) or isinstance(value, type(existing))):
+          raise AssertionError(f"The types of the values for key '{key_path}' are not the same!")
+
+        # If the key maps to a mapping, we merge those mappings
+        if isinstance(existing, Mapping):
+          stack.append((owned_copy(target, key, existing), value, path + (key,)))
+          if value:
+            target_falsy_keys.discard(key)
+        # If the key maps to a list, we concat the lists
+        # (careful, str is a subset of Iterable!)
+        elif isinstance(existing, List):
+          owned_copy(target, key, existing).extend(value)
+          if value:
+            target_falsy_keys.discard(key)
+        # If the key is present in both, but is twice None, then we can merge to None
+        elif existing is None and value is None:
+          pass
+        # In other cases, we do not know what to do...
+        else:
+          raise ValueError(f"Unmergeable type found during merge, key: '{key_path}', " +
+                           f"type: '{type(existing)}'")
+
+  return out
@@ -1,10 +1,10 @@
 
 import json
-import yaml # type: ignore
 
 from base64      import b64decode
 from textwrap    import wrap
-from typing      import Any, Mapping, Optional
+from functools   import lru_cache
+from typing      import Any, BinaryIO, Dict, Iterable, Mapping, Optional, Tuple
 
 import nacl.utils # type: ignore
 from nacl.encoding import RawEncoder, Base64Encoder # type: ignore
@@ -12,6 +12,9 @@ from nacl.public   import PrivateKey, PublicKey, SealedBox  # type: ignore
 from nacl.secret   import SecretBox  # type: ignore
 from nacl.signing  import VerifyKey, SigningKey  # type: ignore
 
+from nixostools import ocb_nixos_lib
+from nixostools.serialization_lib import yaml_load, yaml_dump
+
 
 UTF8: str = "utf-8"
 CHUNK_WIDTH: int = 76
@@ -34,6 +37,15 @@ TUNNELS_KEY    = "tunnels"
 PER_HOST_KEY   = "per-host"
 PUBLIC_KEY_KEY = "public_key"
 
+# Output formats for the generated secrets file.
+# The yaml format is a single YAML document containing the secrets of all servers.
+# The indexed format starts with a magic line and a JSON index mapping every server
+# to the offset and length of its secrets, followed by the secrets of every server
+# as a separate YAML document. A server can then read only its own secrets.
+OUTPUT_FORMAT_YAML    = "yaml"
+OUTPUT_FORMAT_INDEXED = "indexed"
+INDEXED_SECRETS_MAGIC: bytes = b"#nixostools-indexed-secrets-v1\n"
+
 
 def chunk(b64bytes: bytes) -> str:
   wrapped = wrap(b64bytes.decode(UTF8), width=CHUNK_WIDTH)
@@ -83,12 +95,64 @@ def decrypt(box: Any,
 
 
 # takes an ed25519 public key string (only the key itself, without headers or comments)
-# returns an appropriately transformed PublicKey object, usable to create an NaCl SealedBox
-def extract_curve_public_key(openssh_public_key: str) -> PublicKey:
+# returns the raw Ed25519 public key bytes
+def extract_ed25519_public_key(openssh_public_key: str) -> bytes:
   openssh_pub_bytes = b64decode(openssh_public_key)
-  pub_bytes = bytes_after(OPENSSH_PUBLIC_KEY_SIGNATURE, PUBLIC_KEY_LENGTH, openssh_pub_bytes)
+  if OPENSSH_PUBLIC_KEY_SIGNATURE not in openssh_pub_bytes:
+    raise ValueError("The public key does not contain an Ed25519 key.")
+  return bytes_after(OPENSSH_PUBLIC_KEY_SIGNATURE, PUBLIC_KEY_LENGTH, openssh_pub_bytes)
+
+
+# takes raw Ed25519 public key bytes and returns the raw Curve25519 public key bytes
+def ed25519_to_curve25519_public_key(pub_bytes: bytes) -> bytes:
   nacl_pub_ed = VerifyKey(key=pub_bytes, encoder=RawEncoder)
-  return nacl_pub_ed.to_curve25519_public_key()
+  return bytes(nacl_pub_ed.to_curve25519_public_key())
+
+
+# takes an ed25519 public key string (only the key itself, without headers or comments)
+# returns an appropriately transformed PublicKey object, usable to create an NaCl SealedBox
+def extract_curve_public_key(openssh_public_key: str) -> PublicKey:
+  (_, curve_bytes) = convert_public_key(openssh_public_key)
+  return PublicKey(curve_bytes)
+
+
+# Decoding an OpenSSH public key and converting it to Curve25519 is not free,
+# so we cache the results, keyed on the OpenSSH key string (without headers or comments).
+# Returns the raw Ed25519 and Curve25519 public key bytes.
+@lru_cache(maxsize = 4096)
+def convert_public_key(openssh_public_key: str) -> Tuple[bytes, bytes]:
+  pub_bytes = extract_ed25519_public_key(openssh_public_key)
+  return (pub_bytes, ed25519_to_curve25519_public_key(pub_bytes))
+
+
+# Converts the keys of a whole fleet at once, using the conversions persisted
+# in the given cache file for the keys which we converted before.
+# Keys which cannot be converted are left out of the result,
+# use convert_public_key to find out what is wrong with them.
+# The cache file is rewritten with the keys of this batch only,
+# so that keys of removed hosts do not accumulate.
+def convert_public_keys(openssh_public_keys: Iterable[str],
+                        cache_path: Optional[str] = None) -> Dict[str, Tuple[bytes, bytes]]:
+  cache = ocb_nixos_lib.read_json_state(cache_path) if cache_path else {}
+
+  converted: Dict[str, Tuple[bytes, bytes]] = {}
+  for openssh_public_key in set(openssh_public_keys):
+    try:
+      (ed_hex, curve_hex) = cache[openssh_public_key]
+      converted[openssh_public_key] = (bytes.fromhex(ed_hex), bytes.fromhex(curve_hex))
+      continue
+    except (KeyError, TypeError, ValueError):
+      pass
+    try:
+      converted[openssh_public_key] = convert_public_key(openssh_public_key)
+    except Exception:
+      pass
+
+  if cache_path and converted.keys() != cache.keys():
+    ocb_nixos_lib.write_json_state(cache_path, { openssh_public_key: [ ed_bytes.hex(), curve_bytes.hex() ]
+                                                 for (openssh_public_key, (ed_bytes, curve_bytes))
+                                                 in converted.items() })
+  return converted
 
 
 # takes an OpenSSH Ed25519 private key string and transforms it into a Curve25519 private key
@@ -105,9 +169,6 @@ def extract_curve_private_key(priv_key: str) -> PrivateKey:
 def extract_public_key(tunnels_json: Mapping,
                        server: str,
                        public_keys_path: str) -> Optional[PublicKey]:
-  def raise_wrong_format():
-    raise Exception(f"Error parsing the public key for server {server}, wrong format.")
-
   server_tunnel_data = tunnels_json[TUNNELS_KEY][PER_HOST_KEY].get(server)
   if not server_tunnel_data:
     raise Exception(f'Server {server} not found in "{public_keys_path}".')
@@ -115,15 +176,23 @@ def extract_public_key(tunnels_json: Mapping,
     # The server is defined but has an empty public key
     # This happens for servers being provisioned
     return None
-  # Find the public key, strip off the header,
-  # and discard anything following the key
-  pubkey_split = server_tunnel_data[PUBLIC_KEY_KEY].split(maxsplit=2)
+  return extract_curve_public_key(openssh_public_key_chars(server_tunnel_data[PUBLIC_KEY_KEY], server))
+
+
+# Find the public key in an OpenSSH public key line, strip off the header,
+# and discard anything following the key
+def openssh_public_key_chars(public_key: str,
+                             server: str) -> str:
+  def raise_wrong_format():
+    raise Exception(f"Error parsing the public key for server {server}, wrong format.")
+
+  pubkey_split = public_key.split(maxsplit=2)
   if len(pubkey_split) < 2:
     raise_wrong_format()
   pubkey_chars = pubkey_split[1]
   if not len(pubkey_chars) == OPENSSH_PUBLIC_KEY_STRING_LENGTH:
-    raise_wrong_format
-  return extract_curve_public_key(pubkey_chars)
+    raise_wrong_format()
+  return pubkey_chars
 
 
 # Extract length bytes counting from the first occurence of the given signature.
@@ -133,3 +202,59 @@ def bytes_after(signature: bytes,
   start = bytestr.find(signature) + len(signature)
   return bytestr[start:start+length]
 
+
+
+def write_indexed_secrets(f: BinaryIO,
+                          content: Mapping[str, Mapping]) -> None:
+  # Like the YAML format, we sort the servers to get a stable output
+  blobs = [ (server, yaml_dump(content[server], default_style='|').encode(UTF8))
+            for server in sorted(content.keys()) ]
+  # The offsets are relative to the end of the index
+  index: Dict[str, Tuple[int, int]] = {}
+  offset = 0
+  for (server, blob) in blobs:
+    index[server] = (offset, len(blob))
+    offset += len(blob)
+
+  f.write(INDEXED_SECRETS_MAGIC)
+  f.write(json.dumps(index).encode(UTF8) + b"\n")
+  for (_, blob) in blobs:
+    f.write(blob)
+
+
+# Returns the index and the position of the end of the index,
+# or None if the file is not in the indexed format.
+def read_secrets_index(f: BinaryIO) -> Optional[Tuple[Mapping[str, Tuple[int, int]], int]]:
+  if f.readline() != INDEXED_SECRETS_MAGIC:
+    return None
+  index = json.loads(f.readline())
+  return (index, f.tell())
+
+
+def read_generated_secrets(secrets_path: str) -> Mapping[str, Mapping]:
+  with open(secrets_path, 'rb') as f:
+    index = read_secrets_index(f)
+    if index is None:
+      f.seek(0)
+      return yaml_load(f) or {}
+    (server_offsets, data_start) = index
+    f.seek(data_start)
+    data = f.read()
+  return { server: yaml_load(data[offset:offset+length])
+           for (server, (offset, length)) in server_offsets.items() }
+
+
+# Reads the generated secrets of a single server, in either output format.
+def read_server_generated_secrets(secrets_path: str,
+                                  server: str) -> Optional[Mapping]:
+  with open(secrets_path, 'rb') as f:
+    index = read_secrets_index(f)
+    if index is None:
+      f.seek(0)
+      return (yaml_load(f) or {}).get(server)
+    (server_offsets, data_start) = index
+    if server not in server_offsets:
+      return None
+    (offset, length) = server_offsets[server]
+    f.seek(data_start + offset)
+    return yaml_load(f.read(length)) # type: ignore
@@ -0,0 +1,48 @@
+import json
+import yaml # type: ignore
+
+from typing import Any, Mapping, Optional
+
+# The libyaml bindings are a lot faster than the pure Python implementation,
+# we use them when PyYAML was built with them.
+try:
+  from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper # type: ignore
+except ImportError:
+  from yaml import SafeLoader, SafeDumper # type: ignore
+
+
+UTF8 = "utf-8"
+
+# Formats for the decrypted payload containing the secrets of a server.
+# The JSON payload starts with a marker line, which is a comment in YAML,
+# so that we can tell both formats apart when decoding.
+# Payloads without a marker are YAML, as written by older versions.
+PAYLOAD_FORMAT_YAML = "yaml"
+PAYLOAD_FORMAT_JSON = "json"
+PAYLOAD_FORMATS     = [ PAYLOAD_FORMAT_YAML, PAYLOAD_FORMAT_JSON ]
+JSON_PAYLOAD_MARKER = "#nixostools-payload-json-v1\n"
+
+
+def yaml_load(stream: Any) -> Any:
+  return yaml.load(stream, Loader = SafeLoader)
+
+
+def yaml_dump(data: Any, stream: Optional[Any] = None, **kwargs: Any) -> Any:
+  return yaml.dump(data, stream, Dumper = SafeDumper, **kwargs)
+
+
+def encode_payload(secrets: Mapping, payload_format: str = PAYLOAD_FORMAT_YAML) -> str:
+  if payload_format == PAYLOAD_FORMAT_JSON:
+    # We keep the default separators, which makes the JSON valid YAML as well
+    return JSON_PAYLOAD_MARKER + json.dumps(secrets, ensure_ascii = False, sort_keys = True)
+  elif payload_format == PAYLOAD_FORMAT_YAML:
+    return str(yaml_dump(secrets))
+  else:
+    raise ValueError(f"Unknown payload format: {payload_format}")
+
+
+def decode_payload(payload: str) -> Any:
+  if payload.startswith(JSON_PAYLOAD_MARKER):
+    # The payload is padded with newlines, which json.loads ignores
+    return json.loads(payload[len(JSON_PAYLOAD_MARKER):])
+  return yaml_load(payload)
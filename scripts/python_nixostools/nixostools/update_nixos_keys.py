@@ -5,11 +5,15 @@ import argparse
 import json
 import os
 import requests # type: ignore
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from typing    import Iterable, Mapping
+from requests.adapters import HTTPAdapter # type: ignore
+from typing    import Any, Callable, Dict, Iterable, List, Mapping, Optional
 
-from nixostools import ocb_nixos_lib
+from nixostools import fleet_lib, ocb_nixos_lib
 
 
 def args_parser() -> argparse.ArgumentParser:
@@ -17,10 +21,28 @@ def args_parser() -> argparse.ArgumentParser:
   parser.add_argument('--api_token', dest = 'api_token', required = True, type = str)
   parser.add_argument('--nixos_config_dir',   dest = 'nixos_config_dir', required = True)
   parser.add_argument('--tunnel_config_path', dest = 'tunnel_config_path', required = True)
+  parser.add_argument('--json_cache', dest = 'json_cache', required = False, type = str,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'json_configs_cache.json'),
+                      help = 'the JSON file in which we cache the merged tunnel config')
+  parser.add_argument('--fleet_index', dest = 'fleet_index', required = False, type = str,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'fleet_index.bin'),
+                      help = 'the file in which we keep a snapshot of the parsed hosts of the tunnel config')
+  parser.add_argument('--api_url', dest = 'api_url', required = False, type = str, default = DEFAULT_API_URL,
+                      help = f'the URL of the GitHub API (default: {DEFAULT_API_URL})')
+  parser.add_argument('--jobs', dest = 'jobs', required = False, type = int, default = 8,
+                      help = 'the number of requests to make in parallel (default: 8)')
+  parser.add_argument('--etag_cache', dest = 'etag_cache', required = False, type = str,
+                      default = os.path.join(ocb_nixos_lib.cache_dir(), 'github_keys_etag_cache.json'),
+                      help = 'the JSON file in which we keep the ETags of the pages of keys on GitHub')
   parser.add_argument('--dry_run', dest = 'dry_run',   required = False, action = 'store_true')
   return parser
 
 
+DEFAULT_API_URL = "https://api.github.com"
+# The number of times we retry a request after hitting the rate limit
+RATE_LIMIT_RETRIES = 5
+
+
 def headers(api_token: str) -> Mapping:
   return {
     'Accept': 'application/vnd.github.v3+json',
@@ -28,23 +50,104 @@ def headers(api_token: str) -> Mapping:
   }
 
 
-def get_keys_from_github(session: requests.Session, api_token: str) -> Mapping:
+# Returns the number of seconds to wait before retrying, if the response
+# tells us that we hit the rate limit, or None otherwise.
+def rate_limit_delay(response: requests.Response) -> Optional[float]:
+  if response.status_code not in (403, 429):
+    return None
+  if 'Retry-After' in response.headers:
+    return float(response.headers['Retry-After'])
+  if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+    return max(0.0, float(response.headers['X-RateLimit-Reset']) - time.time()) + 1
+  return None
+
+
+print_lock = threading.Lock()
+
+# The keys are updated in parallel, so we prefix every line with the title of the key,
+# and we print the lines belonging together at once.
+def print_lines(title: str, *lines: Any) -> None:
+  with print_lock:
+    for line in lines:
+      print(f'[{title}] {line}')
+
+
+# A session to the GitHub API, which can be shared by multiple threads.
+# The connections are pooled, and when we hit the rate limit,
+# all threads wait until the rate limit resets.
+class GitHubApi:
+  def __init__(self, api_url: str, api_token: str, jobs: int) -> None:
+    self.api_url = api_url.rstrip('/')
+    self.session = requests.Session()
+    self.session.mount(self.api_url, HTTPAdapter(pool_connections = 1, pool_maxsize = jobs))
+    self.session.headers.update(headers(api_token))
+    self.lock = threading.Lock()
+    self.paused_until = 0.0
+
+  def pause_until(self, timestamp: float) -> None:
+    with self.lock:
+      self.paused_until = max(self.paused_until, timestamp)
+
+  def wait_for_rate_limit(self) -> None:
+    with self.lock:
+      delay = self.paused_until - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+    attempts = 0
+    while True:
+      self.wait_for_rate_limit()
+      response = self.session.request(method, url, **kwargs)
+
+      delay = rate_limit_delay(response)
+      if delay is not None and attempts < RATE_LIMIT_RETRIES:
+        attempts += 1
+        with print_lock:
+          print(f"Hit the GitHub rate limit, waiting {delay:.0f}s before retrying {method} {url}...")
+        self.pause_until(time.time() + delay)
+        continue
+
+      # When we used up the rate limit, the next requests wait until it resets
+      if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+        self.pause_until(float(response.headers['X-RateLimit-Reset']) + 1)
+      return response
+
+
+# We keep the ETag and the content of every page of keys,
+# so that we can make conditional requests, to which GitHub answers
+# with 304 Not Modified if the page did not change.
+def get_keys_from_github(api: GitHubApi, etag_cache_path: Optional[str] = None) -> Mapping:
 
   def parse_response(response: Iterable) -> Mapping:
     return { key['title']: {'key': key['key'], 'key_id': key['id']}
              for key in response }
 
-  def do_get_keys(url: str) -> Iterable:
-    response = check_response(session.get(url, headers=headers(api_token)))
-    if 'next' in response.links:
-      return chain(response.json(), do_get_keys(response.links['next']['url']))
+  etag_cache = ocb_nixos_lib.read_json_state(etag_cache_path) if etag_cache_path else {}
+  new_etag_cache: Dict[str, Mapping] = {}
+  keys: List = []
+  url: Optional[str] = f"{api.api_url}/user/keys?per_page=100"
+  while url:
+    cached = etag_cache.get(url)
+    request_headers = { 'If-None-Match': cached['etag'] } if cached else {}
+    response = api.request('GET', url, headers=request_headers)
+    if cached and response.status_code == 304:
+      new_etag_cache[url] = cached
+      (page, next_url) = (cached['page'], cached['next'])
     else:
-      return response.json() # type: ignore
+      page = check_response(response).json()
+      next_url = response.links.get('next', {}).get('url')
+      if response.headers.get('ETag'):
+        new_etag_cache[url] = { 'etag': response.headers['ETag'], 'page': page, 'next': next_url }
+    keys += page
+    url = next_url
 
-  url = f"https://api.github.com/user/keys"
-  response = parse_response(do_get_keys(url))
-  print(f"Loaded {len(response.keys())} keys from GitHub")
-  return response
+  if etag_cache_path:
+    ocb_nixos_lib.write_json_state(etag_cache_path, new_etag_cache)
+
+  key_records = parse_response(keys)
+  print(f"Loaded {len(key_records.keys())} keys from GitHub")
+  return key_records
 
 
 def check_response(response: requests.Response) -> requests.Response:
@@ -52,58 +155,71 @@ def check_response(response: requests.Response) -> requests.Response:
   return response
 
 
-def print_response(response: requests.Response) -> requests.Response:
-  print(f'{response.status_code} {response.reason}')
-  print(response.text)
+def print_response(title: str,
+                   response: requests.Response) -> requests.Response:
+  print_lines(title, f'{response.status_code} {response.reason}', response.text)
   return check_response(response)
 
 
-def delete_key_from_github(session: requests.Session,
-                           api_token: str,
+def delete_key_from_github(api: GitHubApi,
                            title: str,
                            key_id: str,
                            dry_run: bool) -> None:
-  print(f"Deleting key with title {title} and id {key_id} from GitHub...")
-  url = f"https://api.github.com/user/keys/{key_id}"
+  print_lines(title, f"Deleting key with title {title} and id {key_id} from GitHub...")
+  url = f"{api.api_url}/user/keys/{key_id}"
   if not dry_run:
-    print_response(session.delete(url, headers=headers(api_token)))
+    print_response(title, api.request('DELETE', url))
 
 
-def add_key_to_github(session: requests.Session,
-                      api_token: str,
+def add_key_to_github(api: GitHubApi,
                       title: str,
                       key: str,
                       dry_run: bool) -> None:
-  print(f"Adding key with title {title} to GitHub...")
-  url = "https://api.github.com/user/keys"
+  url = f"{api.api_url}/user/keys"
   data = {
     'title': title,
     'key': key,
   }
-  print(data)
+  print_lines(title, f"Adding key with title {title} to GitHub...", data)
   if not dry_run:
-    print_response(session.post(url,
-                                headers=headers(api_token),
-                                data=json.dumps(data)))
+    print_response(title, api.request('POST', url, data=json.dumps(data)))
+
+
+# Runs the given action for every title in a thread pool,
+# and returns the titles for which the action failed.
+def for_all_titles(jobs: int,
+                   action: Callable[[str], None],
+                   titles: Iterable[str]) -> List[str]:
+  def run(title: str) -> Optional[str]:
+    try:
+      action(title)
+      return None
+    except Exception as e:
+      print_lines(title, f"ERROR: failed to update the key with title {title}: {e}")
+      return title
+
+  with ThreadPoolExecutor(max_workers = jobs) as executor:
+    return [ title for title in executor.map(run, sorted(titles)) if title ]
 
 
 def get_keys_from_config(config_dir: str,
-                         tunnel_config_path: str) -> Mapping:
+                         tunnel_config_path: str,
+                         json_cache: Optional[str] = None,
+                         fleet_index_path: Optional[str] = None) -> Mapping:
   nixos_hosts = os.listdir(os.path.join(config_dir, 'hosts'))
 
-  def isElligible(host, tunnel_conf):
-    if f"{host}.nix" in nixos_hosts and tunnel_conf['public_key']:
+  def isElligible(host, host_record):
+    if f"{host}.nix" in nixos_hosts and host_record.public_key:
       return True
     else:
       print(f"Ignoring host {host}, its configuration is not elligible")
       return False
 
-  tunnel_data = ocb_nixos_lib.read_json_configs(tunnel_config_path)
+  fleet_index = fleet_lib.load_fleet_index(tunnel_config_path, fleet_index_path, json_cache)
 
-  tunnel_confs = tunnel_data['tunnels']['per-host']
-  response = { host: {'key': tunnel_conf['public_key']}
-               for (host, tunnel_conf) in tunnel_confs.items()
-               if isElligible(host, tunnel_conf) }
+  response = { host: {'key': host_record.public_key}
+               for (host, host_record) in fleet_index.items()
+               if isElligible(host, host_record) }
 
   print(f"Loaded {len(response.keys())} keys from the local config")
   return response
@@ -111,11 +227,13 @@ def get_keys_from_config(config_dir: str,
 
 def main() -> None:
   args = args_parser().parse_args()
-  session = requests.Session()
+  api = GitHubApi(args.api_url, args.api_token, args.jobs)
 
-  gh_key_records  = get_keys_from_github(session, args.api_token)
+  gh_key_records  = get_keys_from_github(api, args.etag_cache)
   cfg_key_records = get_keys_from_config(args.nixos_config_dir,
-                                         args.tunnel_config_path)
+                                         args.tunnel_config_path,
+                                         args.json_cache,
+                                         args.fleet_index)
   gh_titles  = set(gh_key_records.keys())
   cfg_titles = set(cfg_key_records.keys())
 
@@ -124,19 +242,25 @@ def main() -> None:
   to_change = { title for title in gh_titles.intersection(cfg_titles)
                       if gh_key_records[title]['key'] != cfg_key_records[title]['key'] }
 
-  for title in sorted(chain(to_remove, to_change)):
-    delete_key_from_github(session,
-                           args.api_token,
-                           title,
-                           gh_key_records[title]['key_id'],
-                           args.dry_run)
-
-  for title in sorted(chain(to_add, to_change)):
-    add_key_to_github(session,
-                      args.api_token,
-                      title,
-                      cfg_key_records[title]['key'],
-                      args.dry_run)
+  # We first delete all keys which are removed or changed,
+  # since GitHub does not accept the same key twice.
+  failed = for_all_titles(args.jobs,
+                          lambda title: delete_key_from_github(api,
+                                                               title,
+                                                               gh_key_records[title]['key_id'],
+                                                               args.dry_run),
+                          chain(to_remove, to_change))
+
+  # We do not add the changed keys for which the delete failed
+  failed += for_all_titles(args.jobs,
+                           lambda title: add_key_to_github(api,
+                                                           title,
+                                                           cfg_key_records[title]['key'],
+                                                           args.dry_run),
+                           set(chain(to_add, to_change)).difference(failed))
+
+  if failed:
+    raise Exception(f"Failed to update the keys with the following titles: {', '.join(sorted(failed))}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,49 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 ../shell.nix
+
+import argparse
+import os
+import tempfile
+
+from nixostools import ansible_vault_lib
+
+
+def default_socket_path() -> str:
+  runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+  return os.path.join(runtime_dir, f'nixostools-vault-agent-{os.getuid()}', 'agent.sock')
+
+
+def args_parser() -> argparse.ArgumentParser:
+  parser = argparse.ArgumentParser(
+    description = "Keep the Ansible Vault password and the keys derived from it in memory, " +
+                  "so that the other scripts do not need to ask for the password or derive the keys again.")
+  parser.add_argument("--socket", dest="socket", required=False, type=str, default=default_socket_path(),
+                      help="path of the Unix socket on which the agent listens")
+  parser.add_argument("--idle_timeout", dest="idle_timeout", required=False, type=float, default=3600,
+                      help="number of seconds without requests after which the agent exits, " +
+                           "0 to never exit (default: 3600)")
+  parser.add_argument("--ansible_vault_passwd", dest="ansible_vault_passwd", required=False, type=str,
+                      help="the ansible-vault password, if empty the script will ask for the password")
+  return parser
+
+
+def main() -> None:
+  args = args_parser().parse_args()
+
+  os.environ.pop(ansible_vault_lib.VAULT_AGENT_SOCKET_ENV, None)
+  ansible_vault_passwd = ansible_vault_lib.get_ansible_passwd(args.ansible_vault_passwd)
+
+  print("\nThe vault agent is running, use it from another shell with:")
+  print(f"\nexport {ansible_vault_lib.VAULT_AGENT_SOCKET_ENV}={args.socket}\n", flush = True)
+
+  try:
+    ansible_vault_lib.run_vault_agent(args.socket,
+                                      ansible_vault_passwd,
+                                      args.idle_timeout if args.idle_timeout > 0 else None)
+  except KeyboardInterrupt:
+    pass
+  print("The vault agent stopped.")
+
+
+if __name__ == "__main__":
+  main()
@@ -9,7 +9,8 @@ setup (
       "encrypt_server_secrets = nixostools.encrypt_server_secrets:main",
       "decrypt_server_secrets = nixostools.decrypt_server_secrets:main",
       "add_encryption_key     = nixostools.add_encryption_key:main",
-      "update_nixos_keys      = nixostools.update_nixos_keys:main"
+      "update_nixos_keys      = nixostools.update_nixos_keys:main",
+      "vault_agent            = nixostools.vault_agent:main"
     ]
   },
 )